@@ -0,0 +1,76 @@
+import numpy as np
+import moments
+
+
+class BootstrapReplicates:
+    """
+    Bootstrap replicate spectra stored compactly, as the spectra of the
+    resampled blocks and an integer (replicates x blocks) matrix of how many
+    times each block is drawn in each replicate. Replicates are summed from the
+    blocks when they are accessed, so they are never all held in memory. The
+    object can be passed as `bootstraps` to moments.Demes.Inference.uncerts or
+    as `all_boot` to moments.Godambe.LRT_adjust.
+    """
+
+    def __init__(self, spectra, counts, mask=None, pop_ids=None):
+        self.spectra = np.asarray(spectra, dtype=float)
+        self.counts = np.asarray(counts)
+        if self.counts.shape[1] != len(self.spectra):
+            raise ValueError("expected one column of counts for each block")
+        if mask is None:
+            mask = np.zeros(self.spectra.shape[1:], dtype=bool)
+            mask.flat[[0, -1]] = True
+        self.mask = np.asarray(mask, dtype=bool)
+        self.pop_ids = None if pop_ids is None else list(pop_ids)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def batch(self, reps=None):
+        """
+        Get the replicates with indices `reps`, or all of them, as one array,
+        from one product of their counts and the flattened block spectra.
+        """
+        counts = self.counts if reps is None else self.counts[reps]
+        flat = self.spectra.reshape(len(self.spectra), -1)
+        return (counts @ flat).reshape(len(counts), *self.spectra.shape[1:])
+
+    def stacked(self):
+        """
+        Get all replicates as one array, along with a moments.Spectrum view of
+        each of its rows.
+        """
+        data = self.batch()
+        views = [
+            moments.Spectrum(
+                fs, mask=self.mask, mask_corners=False, copy=False,
+                pop_ids=self.pop_ids
+            )
+            for fs in data
+        ]
+        return data, views
+
+    def __getitem__(self, i):
+        return moments.Spectrum(
+            self.batch([i])[0], mask=self.mask, mask_corners=False,
+            pop_ids=self.pop_ids
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def save(self, file):
+        np.savez_compressed(
+            file,
+            spectra=self.spectra,
+            counts=self.counts,
+            mask=self.mask,
+            pop_ids=np.array(self.pop_ids or [], dtype=str),
+        )
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file) as data:
+            pop_ids = [str(pop) for pop in data["pop_ids"]] or None
+            return cls(data["spectra"], data["counts"], data["mask"], pop_ids)
@@ -1,6 +1,6 @@
 import moments
-import gzip
-import pickle
+
+from bootstraps import BootstrapReplicates
 
 # Load the data
 data = moments.Spectrum.from_file("data/data.fs")
@@ -36,8 +36,7 @@ for p, v in zip(params, vals):
     print(f"{p}\t{v}")
 
 # Compute CIs
-with gzip.open("data/bootstrapped_data.pkl.gz", "rb") as fin:
-    bs_data = pickle.load(fin)
+bs_data = BootstrapReplicates.load("data/bootstrapped_data.npz")
 
 uncerts_FIM = moments.Demes.Inference.uncerts(
     g_out,
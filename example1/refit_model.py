@@ -1,6 +1,6 @@
 import moments
-import gzip
-import pickle
+
+from bootstraps import BootstrapReplicates
 
 # Load the data
 data = moments.Spectrum.from_file("data/data.fs")
@@ -31,8 +31,7 @@ ret = moments.Demes.Inference.optimize(
 )
 
 # Compute CIs
-with gzip.open("data/bootstrapped_data.pkl.gz", "rb") as fin:
-    bs_data = pickle.load(fin)
+bs_data = BootstrapReplicates.load("data/bootstrapped_data.npz")
 
 uncerts = moments.Demes.Inference.uncerts(
     g_out,
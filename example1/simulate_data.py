@@ -1,62 +1,144 @@
+import concurrent.futures
 import demes
+import hashlib
+import json
 import msprime
 import numpy as np
 import moments
-import pickle
-import gzip
+import os
+
+from bootstraps import BootstrapReplicates
 
 _pop_ids = ["popA", "popB"]
 
-def run_sims():
+def simulate_spectra(g, n, L, u, r, seeds):
     """
-    Returns a list of frequency spectra, over some number of replicates.
+    Simulate one replicate region for each (ancestry seed, mutation seed) pair
+    in `seeds`, reducing each tree sequence to its joint spectrum as soon as it
+    is simulated. Each replicate depends only on its own seeds.
+    """
+    sample_sets = [msprime.SampleSet(n, _pop_ids[0]), msprime.SampleSet(n, _pop_ids[1])]
+    demog = msprime.Demography.from_demes(g)
+    spectra = np.zeros((len(seeds), 2*n+1, 2*n+1))
+    for i, (ancestry_seed, mutation_seed) in enumerate(seeds):
+        ts = msprime.sim_ancestry(
+            samples=sample_sets,
+            demography=demog,
+            sequence_length=L,
+            recombination_rate=r,
+            random_seed=ancestry_seed,
+        )
+        mts = msprime.sim_mutations(ts, rate=u, random_seed=mutation_seed)
+        spectra[i] = mts.allele_frequency_spectrum(
+            sample_sets=[range(2*n), range(2*n, 4*n)],
+            polarised=True,
+            span_normalise=False
+        )
+    return spectra
+
+
+def replicate_seeds(num_reps, seed):
+    """
+    Draw an ancestry seed and a mutation seed for each replicate.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(1, 2**32 - 1, size=(num_reps, 2))
+
+
+def simulate_replicates(g, n, L, u, r, seeds, num_procs=None):
+    """
+    Simulate the replicates with the given `seeds` in batches on a pool of
+    `num_procs` processes (by default, one per core), writing their spectra
+    into one array. As every replicate has its own seeds, the spectra do not
+    depend on the number of processes.
+    """
+    num_procs = num_procs or os.cpu_count()
+    spectra = np.zeros((len(seeds), 2*n+1, 2*n+1))
+    if num_procs == 1:
+        spectra[:] = simulate_spectra(g, n, L, u, r, seeds)
+        return spectra
+
+    # several batches per process keep the processes busy until the end
+    batches = np.array_split(np.arange(len(seeds)), 4 * num_procs)
+    with concurrent.futures.ProcessPoolExecutor(num_procs) as pool:
+        futures = {
+            pool.submit(simulate_spectra, g, n, L, u, r, seeds[batch]): batch
+            for batch in batches if len(batch) > 0
+        }
+        for future in concurrent.futures.as_completed(futures):
+            spectra[futures[future]] = future.result()
+    return spectra
+
+
+def cache_key(g, **settings):
+    """
+    Hash a demes graph, normalized by demes and stripped of its descriptive
+    fields, together with the simulation settings and the msprime version.
+    """
+    graph = g.asdict()
+    for field in ("description", "doi", "metadata"):
+        graph.pop(field, None)
+    for deme in graph["demes"]:
+        deme.pop("description", None)
+    content = {"graph": graph, "msprime": msprime.__version__, **settings}
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def run_sims(num_procs=None, cache_dir="data/sim_cache"):
+    """
+    Returns an array of frequency spectra, over some number of replicates.
+    Replicate spectra are cached in `cache_dir` under a hash of the model and
+    the simulation settings. Replicates are seeded one by one from the same
+    stream, so only those beyond the cached ones are simulated.
     """
     g = demes.load("model.yaml")
 
     # sample sizes of 30 diploids from each population
     n = 30
-    sample_sets = [msprime.SampleSet(n, _pop_ids[0]), msprime.SampleSet(n, _pop_ids[1])]
-    demog = msprime.Demography.from_demes(g)
 
     # simulate 500 1Mb regions
     L = 1e6
     u = 1e-8
     r = 1e-8
     num_reps = 500
+    seed = 42
 
-    tss = msprime.sim_ancestry(
-        samples=sample_sets,
-        demography=demog,
-        sequence_length=L,
-        recombination_rate=r,
-        num_replicates=num_reps,
-        random_seed=42,
-    )
+    key = cache_key(g, n=n, L=L, u=u, r=r, seed=seed)
+    cache_file = os.path.join(cache_dir, f"{key}.npy")
+    if os.path.exists(cache_file):
+        spectra = np.load(cache_file)
+    else:
+        spectra = np.zeros((0, 2*n+1, 2*n+1))
+    if len(spectra) < num_reps:
+        seeds = replicate_seeds(num_reps, seed)[len(spectra):]
+        new_spectra = simulate_replicates(g, n, L, u, r, seeds, num_procs)
+        spectra = np.concatenate((spectra, new_spectra))
+        os.makedirs(cache_dir, exist_ok=True)
+        # written under another name first, so that an interrupted run never
+        # leaves a partial cache file
+        np.save(cache_file + ".tmp.npy", spectra)
+        os.replace(cache_file + ".tmp.npy", cache_file)
+    return spectra[:num_reps]
 
-    # get list of replicate spectra
-    spectra = np.zeros((num_reps, 2*n+1, 2*n+1))
-    for i, ts in enumerate(tss):
-        mts = msprime.sim_mutations(ts, rate=u, random_seed=i+13)
-        fs_rep = mts.allele_frequency_spectrum(
-            sample_sets=[range(2*n), range(2*n, 4*n)],
-            polarised=True,
-            span_normalise=False
-        )
-        spectra[i] = fs_rep
-    return spectra
 
-
-def bootstrap_spectra(spectra):
+def bootstrap_spectra(spectra, num_boots=None, seed=None):
     """
-    TODO: complete this docstring
+    Resample the replicate spectra with replacement, `num_boots` times (by
+    default, as many times as there are replicates), using a generator seeded
+    with `seed`. The number of times each replicate is drawn in each bootstrap
+    replicate is drawn at once, as a (num_boots x replicates) multinomial count
+    matrix. Returns the bootstrap replicates as the replicate spectra and these
+    counts, from which they are summed with one matrix product.
     """
+    rng = np.random.default_rng(seed)
     num_reps = len(spectra)
-    bs_spectra = []
-    for _ in range(num_reps):
-        choices = np.random.choice(num_reps, num_reps, replace=True)
-        fs_rep = np.sum(spectra[choices], axis=0)
-        bs_spectra.append(moments.Spectrum(fs_rep, pop_ids=_pop_ids))
-    return bs_spectra
+    num_boots = num_boots or num_reps
+    counts = rng.multinomial(
+        num_reps, np.full(num_reps, 1 / num_reps), size=num_boots
+    )
+    return BootstrapReplicates(spectra, counts, pop_ids=_pop_ids)
 
 
 def main():
@@ -65,9 +147,8 @@ def main():
     fs = moments.Spectrum(fs, pop_ids=_pop_ids)
     fs.tofile("data/data.fs")
 
-    bs_spectra = bootstrap_spectra(spectra)
-    with gzip.open("data/bootstrapped_data.pkl.gz", "wb+") as fout:
-        pickle.dump(bs_spectra, fout)
+    bs_spectra = bootstrap_spectra(spectra, seed=13)
+    bs_spectra.save("data/bootstrapped_data.npz")
 
 if __name__ == "__main__":
     main()
@@ -1,42 +1,36 @@
-# bootstrap over site frequency spectra. also take their sum.
+# bootstrap over site frequency spectra, and build delete-one-window jackknife
+# replicates of them. also take their sum.
 
 import numpy as np
-import moments 
-import pickle
-import pandas
-import random
-import os 
+import sys
 
+sys.path.append("tools")
+from lib import (
+    BootstrapReplicates, SpectrumStack, bootstrap_counts, jackknife_replicates
+)
 
-fnames = sorted(os.listdir("spectra/"))
-region_fs = dict()
-for fname in fnames: 
-    region = ".".join(fname.split(".")[2:4])
-    region_fs[region] = moments.Spectrum.from_file("spectra/" + fname)
 
+# the window spectra and their L, memory-mapped as one array
+windows = SpectrumStack.load("spectra/3pop.projected.windows.stack")
+L_tot = np.sum(windows.L)
 
-L_tbl = pandas.read_csv("region_L_tbl.csv")
-L_tot = np.sum(L_tbl["L"])
 
-
-# resample bootstrap replicates.
+# resample bootstrap replicates. each row of `counts` holds the number of times
+# each window is drawn; only the windows and the counts are stored, and
+# replicates are summed from them when they are read
 n_reps = 100
-n_samps = len(region_fs)
-boot_reps = []
-for ii in range(n_reps):
-    draws = random.choices(list(region_fs.keys()), k=n_samps)
-    boot_fs = 0
-    boot_L = 0
-    for region in draws:
-        boot_fs += region_fs[region]
-        boot_L += np.array(L_tbl[L_tbl["region"] == region]["L"])[0]
-    boot_reps.append((boot_fs, boot_L))
-with open("bootstrap_data.pkl", "wb") as fout:
-    pickle.dump(boot_reps, fout)
+seed = 1
+counts = bootstrap_counts(len(windows), n_reps, seed=seed)
+boot_reps = BootstrapReplicates(windows, counts)
+boot_reps.save("bootstrap_data.boot")
+
+
+# jackknife replicates, one for each window. they are stored as
+# pseudo-replicates that can be passed in place of the bootstrap replicates
+jack_reps = jackknife_replicates(windows)
+jack_reps.save("jackknife_data.stack")
 
 
 # take the sum
-sum_fs = 0
-for region in region_fs:
-    sum_fs += region_fs[region]
-sum_fs.to_file("MSL_GBR_Vindija.fs")
\ No newline at end of file
+sum_fs = windows.sum()
+sum_fs.to_file("MSL_GBR_Vindija.fs")
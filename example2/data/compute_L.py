@@ -1,8 +1,11 @@
 # compute L for each window and save the result
 
 import numpy as np
-import moments 
 import pandas
+import sys
+
+sys.path.append("tools")
+from lib import CallableLength
 
 
 bed_file = lambda chrom: f"bed_files/combined_mask_chr{chrom}.bed.gz"
@@ -25,19 +28,19 @@ genome_file = "hg19.genome"
 seq_lens = load_genome_file(genome_file)
 
 
-# we loop over chromosomes and intervals
+# each mask is read once into an index of callable length, from which the L
+# of all of its intervals is looked up at once
 Ls = {"region": [], "interval": [], "L": []}
 for chrom in range(1, 23):
     length = seq_lens[f"chr{chrom}"]
-    intervals = [[x, y] for x, y 
-                 in zip(range(1, length, l), range(l + 1, length + l, l))]
-    for ii, interval in enumerate(intervals):
-        L = moments.Parsing.compute_L(bed_file(chrom), interval=interval)
+    starts = np.arange(1, length, l)
+    ends = starts + l
+    chrom_Ls = CallableLength.from_bedfile(bed_file(chrom)).lengths(starts, ends)
+    for ii, (start, end, L) in enumerate(zip(starts, ends, chrom_Ls)):
         Ls["region"].append(f"chrom_{chrom}.region_{ii}")
-        Ls["interval"].append(interval)
-        Ls["L"].append(L)
+        Ls["interval"].append([int(start), int(end)])
+        Ls["L"].append(int(L))
 
 
 df = pandas.DataFrame(Ls)
 df.to_csv("region_L_tbl.csv", index=False)
-
@@ -1,16 +1,41 @@
-# compute the frequency spectra across all chromosomes and save them
+# compute the frequency spectra across all chromosomes and save them as one
+# binary stack, labeled by window and holding the sequence length L of each
 
 import numpy as np
-import moments 
+import os
+import sys
+
+sys.path.append("tools")
+from lib import (
+    SiteCounts, SpectrumIndex, SpectrumStack, is_stale, read_bedfile,
+    read_pop_file
+)
+
+
+# the mask, populations and projection that spectra are parsed with
+mask_name = "combined_mask"
+pops = ["MSL", "GBR", "Vindija"]
+sample_sizes = [20, 20, 2]
 
 
 pop_file = "populations.txt"
 vcf_file = lambda chrom: f"vcf_files/annotated_variants_chr{chrom}.vcf.gz"
-bed_file = lambda chrom: f"bed_files/combined_mask_chr{chrom}.bed.gz"
+bed_file = lambda chrom: f"bed_files/{mask_name}_chr{chrom}.bed.gz"
 
 
-# interval size
+# interval size, which must be a multiple of the spacing of the checkpoints at
+# which prefix sums of the spectrum and of L are indexed
 l = 30000000
+step = 1000000
+
+
+# cached counts and indices are named by every setting they were built with,
+# so that changing one builds new files rather than reusing stale ones
+cache_file = lambda chrom: f"count_cache/counts.{mask_name}_chr{chrom}.cnt"
+index_file = lambda chrom: (
+    f"spectra/{'_'.join(pops)}.{'_'.join(map(str, sample_sizes))}"
+    f".{mask_name}.step_{step}.index_chr{chrom}.stack"
+)
 
 
 def load_genome_file(fname):
@@ -19,30 +44,72 @@ def load_genome_file(fname):
         for line in fin:
             chrom, L = line.split()
             ret[chrom] = int(L)
-    return ret 
+    return ret
 
 
 genome_file = "hg19.genome"
 seq_lens = load_genome_file(genome_file)
 
 
-# we loop over chromosomes and intervals
+def load_counts(chrom):
+    """
+    Load the allele counts of all populations at the sites of a chromosome
+    within its mask, parsing the .vcf file only if they have not been cached
+    or the cache is older than the .vcf or mask files.
+    """
+    if is_stale(cache_file(chrom), vcf_file(chrom), bed_file(chrom), pop_file):
+        counts = SiteCounts.from_vcf(
+            vcf_file(chrom), read_pop_file(pop_file), bed_file=bed_file(chrom)
+        )
+        os.makedirs(os.path.dirname(cache_file(chrom)), exist_ok=True)
+        counts.save(cache_file(chrom))
+    return SiteCounts.load(cache_file(chrom))
+
+
+def load_index(chrom, end):
+    """
+    Load the prefix sums of the spectrum and of L at each checkpoint of a
+    chromosome up to `end`, building them from its allele counts if they are
+    not indexed, if the index is older than the counts, or if it stops short
+    of `end`.
+    """
+    counts = load_counts(chrom)
+    if not is_stale(index_file(chrom), cache_file(chrom)):
+        index = SpectrumIndex.load(index_file(chrom))
+        if index.checkpoints[-1] >= end:
+            return index
+    checkpoints = np.arange(1, end + step, step)
+    regions, _ = read_bedfile(bed_file(chrom))
+    # sites are projected to `sample_sizes` as they are tallied. as when the
+    # spectra were parsed at full size and then projected, sites with any
+    # missing genotype in these populations are left out
+    index = SpectrumIndex.from_counts(
+        counts, checkpoints, regions, pops=pops, sample_sizes=sample_sizes,
+        complete_only=True
+    )
+    index.save(index_file(chrom))
+    return SpectrumIndex.load(index_file(chrom))
+
+
+# each chromosome is parsed once into a cache of allele counts and indexed, so
+# that intervals of any size are formed from two lookups each
+window_spectra = []
+labels = []
+Ls = []
 for chrom in range(1, 23):
     L = seq_lens[f"chr{chrom}"]
-    intervals = [[x, y] for x, y in zip(range(1, L, l), range(l + 1, L + l, l))]
-    for ii, interval in enumerate(intervals):
-        try:
-            fs = moments.Spectrum.from_vcf(
-                vcf_file(chrom),
-                bed_file=bed_file(chrom),
-                pop_file=pop_file,
-                pops=["MSL", "GBR", "Vindija"],
-                use_AA=True,
-                verbose=100000,
-                interval=interval,
-            )
-            fs_proj = fs.project([20, 20, 2])
-            fs_proj.to_file(f"spectra/3pop.projected.chrom_{chrom}.region_{ii}.fs")
-        except:
-            print(f"Empty interval chr{chrom} {interval}")
+    # 1-indexed edges of the intervals [x, x + l), the last running past the
+    # chromosome length, as in compute_L.py
+    edges = np.arange(1, L + l, l)
+    windows = load_index(chrom, edges[-1]).windows(edges)
+    for ii, interval in enumerate(zip(edges[:-1], edges[1:])):
+        if windows.L[ii] == 0:
+            print(f"Empty interval chr{chrom} {list(interval)}")
+            continue
+        window_spectra.append(windows[ii])
+        labels.append(f"chrom_{chrom}.region_{ii}")
+        Ls.append(windows.L[ii])
+
 
+stack = SpectrumStack.from_spectra(window_spectra, labels=labels, L=Ls)
+stack.save("spectra/3pop.projected.windows.stack")
@@ -0,0 +1,117 @@
+## benchmark the chunked .bed reader in lib.py against the line-by-line reader
+## it replaced, on a synthetic mask with many short regions, after checking
+## that both readers agree on a few small edge cases.
+## usage: python bench_read_bedfile.py [-n {num_regions}]
+
+import argparse
+import gzip
+import numpy as np
+import os
+import tempfile
+import time
+
+from lib import *
+
+
+def get_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--num_regions", type=int, default=2000000
+    )
+    return parser.parse_args()
+
+
+def read_bedfile_by_line(file):
+    """
+    The former line-by-line implementation of `read_bedfile`.
+    """
+    openfunc = gzip.open if file.endswith(".gz") else open
+    regions = []
+    with openfunc(file, "rb") as fin:
+        for lineb in fin:
+            line = lineb.decode()
+            if "#" in line:
+                continue
+            chromnum, start, end = line.split()[:3]
+            regions.append([int(start), int(end)])
+    region_arr = np.array(regions, dtype=np.int64)
+
+    return region_arr, chromnum
+
+
+def simulate_regions(num_regions, seed=0):
+    """
+    Draw disjoint regions with short gaps and lengths.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 500, size=num_regions)
+    gaps = rng.integers(1, 500, size=num_regions)
+    ends = np.cumsum(lengths + gaps)
+    starts = ends - lengths
+    regions = np.stack((starts, ends), axis=1)
+
+    return regions
+
+
+# small files that the chunked reader must parse as the line-by-line one does
+EDGE_CASES = {
+    "short final line": b"1\t0\t1\n",
+    "short lines": b"1\t100\t200\n1\t0\t1\n",
+    "no final newline": b"chr1\t100\t200\nchr1\t300\t400",
+    "comments": b"# mask\nchr1\t100\t200\nchr1\t300\t400\n",
+    "spaces": b"chr1 100 200\nchr1  300 400\n",
+    "extra columns": b"chr1\t100\t200\tname\nchr1\t300\t400\t.\n",
+    "carriage returns": b"chr1\t100\t200\r\nchr1\t300\t400\r\n",
+}
+
+
+def check_edge_cases(tmpdir):
+    """
+    Check that both readers return the same regions on each edge case.
+    """
+    for name, data in EDGE_CASES.items():
+        file = os.path.join(tmpdir, "edge_case.bed")
+        with open(file, "wb") as fout:
+            fout.write(data)
+        for regions in (read_bedfile(file)[0],
+                        RegionStore.from_bedfile(file).regions):
+            if not np.array_equal(read_bedfile_by_line(file)[0], regions):
+                raise ValueError(f"readers differ on case: {name}")
+    print(f"{len(EDGE_CASES)} edge cases passed")
+
+    return
+
+
+def time_reader(func, file):
+    t0 = time.perf_counter()
+    regions = func(file)[0]
+    t1 = time.perf_counter()
+
+    return regions, t1 - t0
+
+
+def main():
+
+    args = get_args()
+    regions = simulate_regions(args.num_regions)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        check_edge_cases(tmpdir)
+        for suffix in (".bed", ".bed.gz"):
+            file = os.path.join(tmpdir, "bench" + suffix)
+            write_bedfile(file, regions, "chr1")
+            size = os.path.getsize(file) / 1e6
+            by_line, t_line = time_reader(read_bedfile_by_line, file)
+            chunked, t_chunk = time_reader(read_bedfile, file)
+            if not np.array_equal(by_line, chunked):
+                raise ValueError("readers returned different regions")
+            print(f"{suffix}\t{size:.1f} MB\t{len(regions)} regions")
+            print(f"  by line:\t{t_line:.3f} s\t{len(regions) / t_line:.3g} regions/s")
+            print(f"  chunked:\t{t_chunk:.3f} s\t{len(regions) / t_chunk:.3g} regions/s")
+            print(f"  speedup:\t{t_line / t_chunk:.1f}x")
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+## reading and writing BGZF (blocked gzip) files and their tabix indices.
+## BGZF files are ordinary gzip files made of independent members holding at
+## most 64 kb each, so blocks can be compressed on a thread pool and records
+## addressed by virtual offsets (compressed block offset << 16 | offset within
+## the block). See the SAM/BAM and tabix format specifications.
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os
+import struct
+import zlib
+
+
+# uncompressed bytes per block, as in htslib
+BLOCK_SIZE = 0xff00
+
+# the empty block that terminates every BGZF file
+EOF_BLOCK = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000"
+)
+
+# number of blocks handed to the thread pool at once
+_BATCH_BLOCKS = 256
+
+# compressed bytes read and inflated as one batch
+_READ_BATCH = 1 << 22
+
+# the fixed header of a BGZF block, up to the block size field
+_HEADER_SIZE = 18
+
+# tabix linear index window size, as a power of two
+_MIN_SHIFT = 14
+
+
+def compress_block(data, level=6):
+    """
+    Compress at most `BLOCK_SIZE` bytes into a single BGZF block.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack(
+        "<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+        len(cdata) + 25
+    )
+    footer = struct.pack("<II", zlib.crc32(data), len(data))
+
+    return header + cdata + footer
+
+
+class BGZFWriter:
+    """
+    Write a BGZF file, compressing batches of blocks in parallel. Records the
+    compressed offset of every block so that uncompressed offsets can later be
+    converted into virtual offsets.
+    """
+
+    def __init__(self, file, threads=None, level=6):
+        self.fout = open(file, "wb")
+        self.threads = threads or os.cpu_count()
+        self.level = level
+        self.pending = []
+        self.num_pending = 0
+        self.block_offsets = [0]
+        self.num_bytes = 0
+
+    def tell(self):
+        """
+        Get the number of uncompressed bytes written so far.
+        """
+        return self.num_bytes
+
+    def write(self, data):
+        self.pending.append(data)
+        self.num_pending += len(data)
+        self.num_bytes += len(data)
+        if self.num_pending >= _BATCH_BLOCKS * BLOCK_SIZE:
+            self._flush(final=False)
+        return
+
+    def _flush(self, final):
+        data = b"".join(self.pending)
+        num_full = len(data) // BLOCK_SIZE
+        cut = len(data) if final else num_full * BLOCK_SIZE
+        chunks = [data[i:i + BLOCK_SIZE] for i in range(0, cut, BLOCK_SIZE)]
+        with ThreadPoolExecutor(self.threads) as pool:
+            blocks = list(
+                pool.map(lambda chunk: compress_block(chunk, self.level), chunks)
+            )
+        for block in blocks:
+            self.fout.write(block)
+            self.block_offsets.append(self.block_offsets[-1] + len(block))
+        self.pending = [data[cut:]]
+        self.num_pending = len(data) - cut
+        return
+
+    def close(self):
+        self._flush(final=True)
+        self.fout.write(EOF_BLOCK)
+        self.fout.close()
+        return
+
+    def virtual_offsets(self, offsets):
+        """
+        Convert an array of uncompressed offsets into virtual offsets.
+        """
+        offsets = np.asarray(offsets, dtype=np.uint64)
+        block_offsets = np.array(self.block_offsets, dtype=np.uint64)
+        blocks = offsets // np.uint64(BLOCK_SIZE)
+        within = offsets % np.uint64(BLOCK_SIZE)
+        # the end of the last block is the start of the block that follows it
+        at_end = offsets == self.num_bytes
+        blocks[at_end] = len(block_offsets) - 1
+        within[at_end] = 0
+
+        return (block_offsets[blocks] << np.uint64(16)) | within
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_bgzf(file):
+    """
+    Check whether a file starts with a BGZF block header.
+    """
+    with open(file, "rb") as fin:
+        header = fin.read(_HEADER_SIZE)
+
+    return _is_block_header(header, 0)
+
+
+def _is_block_header(data, i):
+    # a gzip member with a single 6-byte extra field holding the BC subfield
+    return data[i:i + 4] == b"\x1f\x8b\x08\x04" \
+        and data[i + 10:i + 16] == b"\x06\x00BC\x02\x00"
+
+
+def _split_blocks(data):
+    """
+    Find the complete BGZF blocks at the start of `data`. Returns a list of
+    (offset, size) pairs and the number of bytes they span.
+    """
+    blocks = []
+    i = 0
+    while i + _HEADER_SIZE <= len(data):
+        if not _is_block_header(data, i):
+            raise ValueError(f"invalid BGZF block header at byte {i}")
+        size = int.from_bytes(data[i + 16:i + 18], "little") + 1
+        if i + size > len(data):
+            break
+        blocks.append((i, size))
+        i += size
+
+    return blocks, i
+
+
+def _inflate_block(block):
+    """
+    Decompress a single BGZF block and check its length and checksum.
+    """
+    data = zlib.decompress(block[_HEADER_SIZE:-8], -15)
+    crc, size = struct.unpack("<II", block[-8:])
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise ValueError("corrupt BGZF block")
+
+    return data
+
+
+def iter_bgzf_chunks(file, threads=None):
+    """
+    Decompress a BGZF file, inflating blocks on a thread pool (zlib releases
+    the GIL). Yields the uncompressed data in order, in chunks spanning about
+    `_READ_BATCH` compressed bytes. The next batch is inflated while the
+    current one is being consumed.
+    """
+    tail = b""
+    pending = None
+    with open(file, "rb") as fin, \
+            ThreadPoolExecutor(threads or os.cpu_count()) as pool:
+        while True:
+            raw = fin.read(_READ_BATCH)
+            data = memoryview(tail + raw)
+            blocks, cut = _split_blocks(data)
+            tail = bytes(data[cut:])
+            inflated = pool.map(
+                _inflate_block, [data[i:i + size] for i, size in blocks]
+            )
+            if pending is not None:
+                yield b"".join(pending)
+            pending = inflated
+            if not raw:
+                break
+    if len(tail) > 0:
+        raise ValueError("BGZF file is truncated")
+    yield b"".join(pending)
+
+
+def _reg2bin(begs, ends):
+    """
+    Get the smallest tabix bin containing each 0-based half-open interval.
+    """
+    ends = ends - 1
+    bins = np.zeros(len(begs), dtype=np.int64)
+    unset = np.ones(len(begs), dtype=bool)
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        same = unset & ((begs >> shift) == (ends >> shift))
+        bins[same] = offset + (begs[same] >> shift)
+        unset &= ~same
+
+    return bins
+
+
+def _build_bins(begs, ends, voff_begs, voff_ends):
+    """
+    Build the binning index of one reference sequence: a dict mapping each bin
+    to a list of (start, end) virtual offset chunks. Chunks are compressed as
+    htslib does, so the index matches the one written by `tabix`.
+    """
+    bins = _reg2bin(begs, ends)
+    # consecutive records falling into the same bin form one chunk
+    firsts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+    lasts = np.append(firsts[1:], len(bins)) - 1
+    index = {}
+    for b, beg, end in zip(
+        bins[firsts].tolist(), voff_begs[firsts].tolist(),
+        voff_ends[lasts].tolist()
+    ):
+        index.setdefault(b, []).append((beg, end))
+    # move the chunks of bins spanning less than 64 kb of compressed data into
+    # their parent bins, when those exist
+    for first, last in ((4681, 37449), (585, 4680), (73, 584), (9, 72), (1, 8)):
+        for b in [b for b in index if first <= b <= last]:
+            chunks = index[b]
+            parent = (b - 1) >> 3
+            if (chunks[-1][1] >> 16) - (chunks[0][0] >> 16) < 0x10000 \
+                    and parent in index:
+                index[parent] = sorted(index[parent] + index.pop(b))
+    # merge chunks that touch the same block
+    for b, chunks in index.items():
+        merged = [chunks[0]]
+        for beg, end in chunks[1:]:
+            if merged[-1][1] >> 16 >= beg >> 16:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((beg, end))
+        index[b] = merged
+
+    return index
+
+
+def _build_linear_index(begs, ends, voff_begs):
+    """
+    Build the linear index of one reference sequence, holding for each 16 kb
+    window the virtual offset of the first record that overlaps it.
+    """
+    w0 = begs >> _MIN_SHIFT
+    w1 = (ends - 1) >> _MIN_SHIFT
+    counts = w1 - w0 + 1
+    windows = np.repeat(w0, counts) + np.arange(counts.sum()) \
+        - np.repeat(np.cumsum(counts) - counts, counts)
+    windows, first = np.unique(windows, return_index=True)
+    offsets = np.zeros(windows[-1] + 1, dtype=np.uint64)
+    is_set = np.zeros(len(offsets), dtype=bool)
+    offsets[windows] = np.repeat(voff_begs, counts)[first]
+    is_set[windows] = True
+    # fill empty windows with the offset of the following window, as htslib
+    # does; the last window always holds a record
+    idx = np.minimum.accumulate(
+        np.where(is_set, np.arange(len(offsets)), len(offsets))[::-1]
+    )[::-1]
+    offsets = offsets[idx]
+
+    return offsets
+
+
+def write_tabix_index(file, chromnum, begs, ends, voff_begs, voff_ends,
+                      col_beg=2, col_end=3, zero_based=False):
+    """
+    Write a tabix (.tbi) index for a BGZF file holding records on a single
+    chromosome, given their 0-based half-open intervals and virtual offsets.
+    """
+    begs = np.asarray(begs, dtype=np.int64)
+    ends = np.maximum(np.asarray(ends, dtype=np.int64), begs + 1)
+    fmt = 0x10000 if zero_based else 0
+    name = chromnum.encode() + b"\0"
+    parts = [
+        b"TBI\1",
+        struct.pack("<8i", 1, fmt, 1, col_beg, col_end, ord("#"), 0, len(name)),
+        name,
+    ]
+    if len(begs) > 0:
+        bins = _build_bins(begs, ends, voff_begs, voff_ends)
+        linear = _build_linear_index(begs, ends, voff_begs)
+        # the pseudo-bin holds the span of the records and their count
+        bins[37450] = [
+            (int(voff_begs[0]), int(voff_ends[-1])), (len(begs), 0)
+        ]
+    else:
+        bins = {}
+        linear = np.zeros(0, dtype=np.uint64)
+    parts.append(struct.pack("<i", len(bins)))
+    for b in sorted(bins):
+        chunks = np.array(bins[b], dtype=np.uint64)
+        parts.append(struct.pack("<Ii", b, len(chunks)))
+        parts.append(chunks.astype("<u8").tobytes())
+    parts.append(struct.pack("<i", len(linear)))
+    parts.append(linear.astype("<u8").tobytes())
+    # the number of records without coordinates
+    parts.append(struct.pack("<Q", 0))
+    data = b"".join(parts)
+    with open(file, "wb") as fout:
+        for i in range(0, len(data), BLOCK_SIZE):
+            fout.write(compress_block(data[i:i + BLOCK_SIZE]))
+        fout.write(EOF_BLOCK)
+
+    return
+
+
+def write_bgzf_table(file, chromnum, chunks, begs, ends, header=b"",
+                     index=False, col_beg=2, col_end=3, zero_based=False,
+                     threads=None):
+    """
+    Write formatted lines on a single chromosome to a BGZF file. `chunks` is
+    an iterable of bytes objects holding complete lines, one line for each of
+    the 0-based half-open intervals [begs, ends). When `index` is True a tabix
+    index is written alongside it, without re-reading the file.
+    """
+    line_begs = []
+    with BGZFWriter(file, threads=threads) as writer:
+        writer.write(header)
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10)
+            line_begs.append(
+                writer.tell() + np.concatenate(([0], newlines[:-1] + 1))
+            )
+            writer.write(chunk)
+    if index:
+        line_begs = np.concatenate([np.zeros(0, dtype=np.int64)] + line_begs)
+        line_ends = np.append(line_begs[1:], writer.tell())
+        write_tabix_index(
+            file + ".tbi",
+            chromnum,
+            begs,
+            ends,
+            writer.virtual_offsets(line_begs),
+            writer.virtual_offsets(line_ends),
+            col_beg=col_beg,
+            col_end=col_end,
+            zero_based=zero_based,
+        )
+
+    return
@@ -0,0 +1,35 @@
+## convert the ancestral sequence in a .fa file into a compact binary cache,
+## holding 2-bit nucleotide codes and a bitmask of high-confidence states.
+## caches are read by get_fa_coverage.py and get_ancestral_states.py in place
+## of the .fa file.
+## usage: python build_ancestral_cache.py -f {input.fa} -o {output.anc}
+
+import argparse
+
+from lib import *
+
+
+def get_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-f", "--fasta_file", required=True
+    )
+    parser.add_argument(
+        "-o", "--out_file", required=True
+    )
+    return parser.parse_args()
+
+
+def main():
+
+    args = get_args()
+    fa = FastaFile(args.fasta_file)
+    states = AncestralStates.from_fasta(fa, fa.names[0])
+    states.save(args.out_file)
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+## count the derived and called alleles of every population at each site of a
+## .vcf file with ancestral state annotations, and save them as a binary cache.
+## spectra of any populations, projections or windows are then computed from
+## the cache by parse_sfs_old.py, without re-reading the .vcf file.
+## usage: python build_count_cache.py -v {input.vcf} -p {input.pops} -o {output.cnt}
+
+import argparse
+
+from lib import *
+
+
+def get_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-v", "--vcf_file", required=True
+    )
+    parser.add_argument(
+        "-p", "--population_file", required=True
+    )
+    parser.add_argument(
+        "-b", "--bed_file", default=None,
+        help="only cache sites within the regions of this .bed file"
+    )
+    parser.add_argument(
+        "-o", "--out_file", required=True
+    )
+    return parser.parse_args()
+
+
+def main():
+
+    args = get_args()
+    pop_mapping = read_pop_file(args.population_file)
+    counts = SiteCounts.from_vcf(
+        args.vcf_file, pop_mapping, bed_file=args.bed_file
+    )
+    counts.save(args.out_file)
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,13 @@
 ## extend `--remove` mask by `flank` bp
 ## remove sites in extended mask from intersected mask
 ## output remaining mask
+## input .bed files may hold any number of chromosomes; `--chrom` selects one,
+## and only its lines are read from uncompressed inputs, through a byte index
+## written next to each file by index_bedfile.py (or on first use)
 
-## Because we use uint8 types to count overlaps, this script cannot handle more
-## than 256 masks at once : )
+## Mask arithmetic sweeps over region endpoints, so its cost scales with the
+## number of regions rather than chromosome length and any number of masks can
+## be combined at once.
 
 import argparse 
 import gzip
@@ -27,6 +31,10 @@ def get_args():
     parser.add_argument(
         "-flank", "--flank", type=float, default=None
     )  
+    parser.add_argument(
+        "-c", "--chrom", default=None,
+        help="chromosome to combine, required if inputs hold several"
+    )
     parser.add_argument(
         "-o", "--out_file", required=True
     )
@@ -40,11 +48,23 @@ def main():
     sub_files = args.subtract
     flank = int(args.flank) if args.flank is not None else None
     out_file = args.out_file
-    chromnum = read_bedfile(isec_files[0])[1]
-    isec_regions = [read_bedfile(file)[0] for file in isec_files]
+    chromnum = args.chrom
+    # with --chrom, only the lines of that chromosome are read from inputs
+    chroms = None if chromnum is None else [chromnum]
+    isec_stores = [
+        RegionStore.from_bedfile(file, chroms=chroms) for file in isec_files
+    ]
+    if chromnum is None:
+        if len(isec_stores[0]) != 1:
+            raise ValueError("inputs hold several chromosomes; pass --chrom")
+        chromnum = isec_stores[0].chroms[0]
+    isec_regions = [store[chromnum] for store in isec_stores]
     isec = intersect_regions(isec_regions)
     if len(sub_files) > 0:
-        sub_regions = [read_bedfile(file)[0] for file in sub_files]
+        sub_regions = [
+            RegionStore.from_bedfile(file, chroms=[chromnum])[chromnum]
+            for file in sub_files
+        ]
         union = union_regions(sub_regions)
         if flank is not None:   
             union = flank_regions(union, flank)
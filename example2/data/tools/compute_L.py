@@ -1,7 +1,7 @@
 ## compute the total length of sequence in several .bed files
 ## the parameter L is required to obtain the expected SFS
+## files holding several chromosomes also report L for each chromosome
 
-import numpy as np
 import sys
 
 from lib import *
@@ -12,12 +12,18 @@ def main():
     bed_files = sys.argv[1:]
     L_tot = 0
     for file in bed_files: 
-        regions = read_bedfile(file)[0]
-        raw_L = np.diff(regions, axis=1).sum()
-        _regions = boolmask_to_regions(regions_to_boolmask(regions))
-        L = int(np.diff(_regions, axis=1).sum())
-        if raw_L != L:
-            raise ValueError(f"file {file} has overlapping regions")
+        store = RegionStore.from_bedfile(file)
+        L = 0
+        for chromnum in store.chroms:
+            regions = store[chromnum]
+            if regions_overlap(regions):
+                raise ValueError(
+                    f"file {file} has overlapping regions on {chromnum}"
+                )
+            chrom_L = CallableLength(regions).total
+            if len(store) > 1:
+                print(f"L_{file}_{chromnum} =\t{chrom_L}")
+            L += chrom_L
         print(f"L_{file} =\t{L}")
         L_tot += L
     print(f"L_tot =\t{L_tot}")
@@ -1,13 +1,14 @@
 ## Write a file recording the estimated ancestral nucleotide state from a .fa
-## file for every site in an input .vcf file. 
+## file, or from an ancestral state cache built by build_ancestral_cache.py, for
+## every site in an input .vcf file. 
 ## output file has columns `chrom` `pos` `state`
 
-## This script will throw an error if any .vcf sites are not assigned with 
-## high confidence (denoted by capitalized nucleotide codes e.g. A) in .fa file.
-## It is assumed that the input .vcf has already been masked to account for this
+## This script will throw an error listing every .vcf site that is not assigned
+## with high confidence (denoted by capitalized nucleotide codes e.g. A) in .fa
+## file. It is assumed that the input .vcf has already been masked to account
+## for this. Positions are read and states looked up as whole arrays.
 
 import argparse
-import gzip 
 import numpy as np
 
 from lib import *
@@ -19,11 +20,16 @@ def get_args():
     parser.add_argument(
         "-v", "--vcf_file", required=True
     )
-    parser.add_argument(
-        "-f", "--fasta_file", required=True
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "-f", "--fasta_file"
+    )
+    source.add_argument(
+        "-a", "--ancestral_cache"
     )
     parser.add_argument(
-        "-o", "--out_file", required=True, help=".tab or .tab.gz format"
+        "-o", "--out_file", required=True,
+        help=".tab or .tab.gz format; .tab.gz files are indexed with tabix"
     )
 
     return parser.parse_args()
@@ -33,29 +39,25 @@ def main():
 
     args = get_args()
     vcf_file = args.vcf_file
-    fasta_file = args.fasta_file
     out_file = args.out_file
-    fa_array = load_fa_array(fasta_file)[1]
-    positions = []
-    states = []
-    openfunc = gzip.open if vcf_file.endswith(".gz") else open 
-    with openfunc(vcf_file, "rb") as fin:
-        for lineb in fin:
-            line = lineb.decode()
-            if "#" in line:
-                continue
-            chromnum, pos = line.split()[:2]
-            # .fa file treated as 0-indexed
-            position0 = int(pos) - 1
-            state = fa_array[position0]
-            if state not in ("A", "T", "G", "C"):
-                raise ValueError(
-                    f"pos {position0} lacks high-confidence state assignment"
-                )
-            # use 1-indexed position for output
-            positions.append(pos)
-            states.append(state)
-    write_tab_file(out_file, positions, states, chromnum)
+    positions, chromnum = read_vcf_positions(vcf_file)
+    # .fa file treated as 0-indexed
+    if args.ancestral_cache is not None:
+        anc = AncestralStates.load(args.ancestral_cache)
+        states, high_conf = anc.take(positions - 1)
+    else:
+        fa = FastaFile(args.fasta_file)
+        states = fa.take(fa.names[0], positions - 1)
+        high_conf = is_high_confidence(states)
+    if not np.all(high_conf):
+        failed = positions[~high_conf] - 1
+        raise ValueError(
+            f"{len(failed)} positions lack high-confidence state assignments: "
+            + ", ".join(map(str, failed))
+        )
+    # use 1-indexed position for output
+    states = states.view("S1")
+    write_tab_file(out_file, positions, states, chromnum, index=True)
 
     return
 
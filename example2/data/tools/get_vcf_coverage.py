@@ -2,9 +2,10 @@
 ## intended to record coverage of GVCF files. 
 ## usage: python get_vcf_coverage.py -i {input.vcf.gz} -o {output.bed.gz}
 ## written 25-02-2025 
+## positions are streamed in large chunks, and runs are split with np.diff; a
+## run left open at the end of a chunk is carried into the next one.
 
 import argparse 
-import gzip
 import numpy as np 
 
 from lib import *
@@ -27,30 +28,24 @@ def main():
     args = get_args()
     in_file = args.in_file
     out_file = args.out_file
-    i = 0
-    start = None
-    lastpos = None
+    # the run left open at the end of the previous chunk
+    run = None
     regions = []
-    openfunc = gzip.open if in_file.endswith(".gz") else open
-    with openfunc(in_file, "rb") as fin:
-        for bline in fin:
-            line = bline.decode()
-            if line.startswith("#"):
-                continue
-            pos = int(line.split()[1])
-            if i == 0:
-                start = pos
+    for chromnum, positions in iter_vcf_positions(in_file):
+        breaks = np.flatnonzero(np.diff(positions) > 1)
+        starts = np.append(positions[:1], positions[breaks + 1])
+        ends = np.append(positions[breaks], positions[-1])
+        if run is not None:
+            if starts[0] - run[1] > 1:
+                regions.append([run])
             else:
-                if pos - lastpos > 1:
-                    regions.append([start, lastpos])
-                    start = pos
-            i += 1
-            lastpos = pos
-    regions.append([start, lastpos])
-    region_arr = np.array(regions, dtype=np.int64)
+                starts[0] = run[0]
+        regions.append(np.stack((starts[:-1], ends[:-1]), axis=1))
+        run = (starts[-1], ends[-1])
+    regions.append([run])
+    region_arr = np.concatenate(regions).astype(np.int64)
     # recall that .bed file `start` positions are 0-indexed
     region_arr[:, 0] -= 1
-    chromnum = line.split()[0]
     write_bedfile(out_file, region_arr, chromnum)
 
     return 
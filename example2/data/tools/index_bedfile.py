@@ -0,0 +1,29 @@
+## index the byte ranges of the chromosomes in an uncompressed .bed file, so
+## that scripts loading one chromosome through `RegionStore` read only its
+## lines. the index is written to {bed_file}.bci.
+## usage: python index_bedfile.py -i {input.bed}
+
+import argparse
+
+from lib import *
+
+
+def get_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i", "--bed_file", required=True
+    )
+    return parser.parse_args()
+
+
+def main():
+
+    args = get_args()
+    load_bed_index(args.bed_file)
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,38 @@
 ## utilities used by scripts
 
+import functools
 import gzip
+import math
 import numpy as np
+import os
+import sys
+import warnings
+
+from bgzf import is_bgzf, iter_bgzf_chunks, write_bgzf_table
+
+
+# number of sites handled at once when packing and unpacking masks
+_CHUNK_SIZE = 1 << 24
+
+# number of set bits in each possible byte
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
 
 
 def regions_to_boolmask(regions, l=None):
     """
     Transform an array of regions into a boolean mask where `1` denotes sites
-    outside the mask and `0` sites within it.
+    outside the mask and `0` sites within it. The mask is built from a
+    difference array of region starts and ends and its cumulative sum.
     """
     if l is None:
         l = regions[-1, 1]
-    boolmask = np.ones(l, dtype=bool)
-    for start, end in regions:
-        if start >= l:
-            break
-        boolmask[start:end] = False
+    merged = merge_regions(np.clip(regions, 0, l))
+    # merged regions are disjoint and non-adjacent, so depth is at most 1
+    diff = np.zeros(l + 1, dtype=np.int8)
+    diff[merged[:, 0]] = 1
+    diff[merged[:, 1]] = -1
+    np.cumsum(diff, out=diff)
+    boolmask = diff[:l] == 0
 
     return boolmask
 
@@ -32,49 +49,1924 @@ def boolmask_to_regions(boolmask):
     return regions
 
 
-def read_bedfile(file):
+class PackedMask:
     """
-    Read a .bed file and return an array of regions and the chromosome number,
-    represented as a string.
+    A mask stored with one bit per site, where set bits denote sites within the
+    mask. This is the opposite convention to boolmasks, so that `count` gives
+    the number of sites in the mask.
+    """
+
+    def __init__(self, bits, length):
+        self.bits = bits
+        self.length = length
+
+    @classmethod
+    def from_regions(cls, regions, l=None):
+        """
+        Build a packed mask from an array of regions, one chunk at a time.
+        """
+        if l is None:
+            l = regions[-1, 1]
+        merged = merge_regions(np.clip(regions, 0, l))
+        bits = np.zeros((l + 7) // 8, dtype=np.uint8)
+        for c0 in range(0, l, _CHUNK_SIZE):
+            c1 = min(c0 + _CHUNK_SIZE, l)
+            lo = np.searchsorted(merged[:, 1], c0, side="right")
+            hi = np.searchsorted(merged[:, 0], c1, side="left")
+            chunk = np.clip(merged[lo:hi] - c0, 0, c1 - c0)
+            inside = ~regions_to_boolmask(chunk, l=c1 - c0)
+            bits[c0 // 8:(c1 + 7) // 8] = np.packbits(inside)
+
+        return cls(bits, l)
+
+    @classmethod
+    def from_boolmask(cls, boolmask):
+        """
+        Build a packed mask from a boolmask where 1 is 'masked out'.
+        """
+        bits = np.packbits(~np.asarray(boolmask, dtype=bool))
+
+        return cls(bits, len(boolmask))
+
+    def to_boolmask(self):
+        """
+        Unpack into a boolmask where 1 is 'masked out'.
+        """
+        inside = np.unpackbits(self.bits, count=self.length).astype(bool)
+
+        return ~inside
+
+    def to_regions(self):
+        """
+        Transform the mask into an array of regions, one chunk at a time.
+        """
+        starts = []
+        ends = []
+        prev = 0
+        for c0 in range(0, self.length, _CHUNK_SIZE):
+            c1 = min(c0 + _CHUNK_SIZE, self.length)
+            inside = np.unpackbits(
+                self.bits[c0 // 8:(c1 + 7) // 8], count=c1 - c0
+            ).astype(np.int8)
+            jumps = np.diff(np.concatenate(([prev], inside)))
+            starts.append(np.where(jumps == 1)[0] + c0)
+            ends.append(np.where(jumps == -1)[0] + c0)
+            prev = inside[-1]
+        if prev == 1:
+            ends.append(np.array([self.length]))
+        regions = np.stack(
+            [np.concatenate(starts + [[]]), np.concatenate(ends + [[]])], axis=1
+        ).astype(np.int64)
+
+        return regions
+
+    def count(self):
+        """
+        Get the number of sites in the mask by counting set bits.
+        """
+        return int(_POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def _check_length(self, other):
+        if self.length != other.length:
+            raise ValueError(
+                f"mask lengths {self.length} and {other.length} do not match"
+            )
+
+    def __and__(self, other):
+        self._check_length(other)
+        return PackedMask(self.bits & other.bits, self.length)
+
+    def __or__(self, other):
+        self._check_length(other)
+        return PackedMask(self.bits | other.bits, self.length)
+
+    def __invert__(self):
+        bits = ~self.bits
+        # clear the padding bits that follow the last site
+        pad = 8 * len(bits) - self.length
+        if pad > 0:
+            bits[-1] &= np.uint8((0xFF << pad) & 0xFF)
+        return PackedMask(bits, self.length)
+
+
+# number of bytes read at once when parsing text files
+_READ_SIZE = 1 << 24
+
+# zero bytes prepended to text buffers so that fields can be right-aligned
+_PAD_SIZE = 32
+
+_DIGITS = b"0123456789"
+
+# masks keeping the first k bytes of a little- or big-endian uint64
+_NAME_MASKS = np.array(
+    [int.from_bytes(b"\xff" * k + b"\x00" * (8 - k), sys.byteorder)
+     for k in range(9)],
+    dtype=np.uint64
+)
+
+
+def _iter_data_chunks(file):
     """
+    Read a file (supports .gz) in chunks of about `_READ_SIZE` bytes. BGZF
+    files are decompressed on a thread pool.
+    """
+    if file.endswith(".gz") and is_bgzf(file):
+        yield from iter_bgzf_chunks(file)
+        return
     openfunc = gzip.open if file.endswith(".gz") else open 
-    regions = []
     with openfunc(file, "rb") as fin:
-        for lineb in fin:
-            line = lineb.decode()
-            if "#" in line:
-                continue
-            chromnum, start, end = line.split()[:3]
-            regions.append([int(start), int(end)])
-    region_arr = np.array(regions, dtype=np.int64)
+        while True:
+            data = fin.read(_READ_SIZE)
+            if not data:
+                break
+            yield data
+
+
+def _iter_line_chunks(file):
+    """
+    Read a text file (supports .gz) in large chunks, yielding bytes objects
+    that hold complete lines.
+    """
+    tail = b""
+    for data in _iter_data_chunks(file):
+        data = tail + data
+        cut = data.rfind(b"\n") + 1
+        tail = data[cut:]
+        if cut > 0:
+            yield data[:cut]
+    if len(tail) > 0:
+        # the final line lacks a newline
+        yield tail + b"\n"
+
+
+def _parse_ints(buf, starts, ends):
+    """
+    Parse the decimal integers held in byte ranges [starts, ends) of the uint8
+    array `buf`. Each field is gathered right-aligned into a fixed-width row
+    of bytes and the rows are reduced one column at a time. Bytes to the left
+    of a field only contribute multiples of 10 ** len(field), which the modulo
+    removes. Digits are not validated here.
+    """
+    lengths = ends - starts
+    width = int(np.max(lengths))
+    if width > 16:
+        raise ValueError("encountered an integer field with too many digits")
+    rows = np.lib.stride_tricks.sliding_window_view(buf, width)[ends - width]
+    values = np.zeros(len(starts), dtype=np.int64)
+    for k in range(width):
+        values *= 10
+        values += rows[:, k]
+    # remove the ASCII offset of each digit before dropping the garbage
+    values -= 48 * int("1" * width)
+    values %= 10 ** lengths
+
+    return values
+
+
+def _parse_bed_lines(data):
+    """
+    Parse complete lines of a .bed file one at a time, splitting each on any
+    whitespace. Used for chunks that are not plain tab-delimited three-column
+    lines. Empty lines are skipped.
+    """
+    regions = []
+    labels = []
+    chromnum = None
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) == 0:
+            continue
+        if len(fields) < 3:
+            raise ValueError("encountered a line with fewer than three fields")
+        if fields[0] != chromnum:
+            chromnum = fields[0]
+            labels.append((len(regions), chromnum.decode()))
+        regions.append([int(fields[1]), int(fields[2])])
+    region_arr = np.array(regions, dtype=np.int64).reshape(-1, 2)
+
+    return region_arr, labels
+
+
+def _parse_bed_chunk(data):
+    """
+    Parse a bytes object holding complete lines of a .bed file. Lines
+    containing `#` are skipped. Chunks of plain tab-delimited lines with three
+    fields are parsed with array operations, and any others line by line.
+    Returns an array of regions and a list of (row, chromnum) pairs marking
+    the rows where the chromosome changes.
+    """
+    if b"#" in data:
+        data = b"".join(
+            line for line in data.splitlines(keepends=True) if b"#" not in line
+        )
+    # padded at the end too, so that eight bytes can be read from the start
+    # of every line, however short
+    buf = np.frombuffer(bytes(_PAD_SIZE) + data + bytes(8), dtype=np.uint8)
+    end = _PAD_SIZE + len(data)
+    seps = np.flatnonzero(buf[_PAD_SIZE:end] < 14) + _PAD_SIZE
+    kinds = buf[seps]
+    regular = (
+        b" " not in data
+        and len(seps) % 3 == 0
+        and np.all(kinds[0::3] == 9)
+        and np.all(kinds[1::3] == 9)
+        and np.all(kinds[2::3] == 10)
+    )
+    if not regular:
+        # spaces, carriage returns, empty lines or extra columns
+        return _parse_bed_lines(data)
+    if len(seps) == 0:
+        return np.zeros((0, 2), dtype=np.int64), []
+    chrom_ends = seps[0::3]
+    start_ends = seps[1::3]
+    line_ends = seps[2::3]
+    line_starts = np.concatenate(([_PAD_SIZE], line_ends[:-1] + 1))
+    if np.any(start_ends - chrom_ends < 2) or np.any(line_ends - start_ends < 2):
+        raise ValueError("encountered an empty integer field")
+    starts = _parse_ints(buf, chrom_ends + 1, start_ends)
+    ends = _parse_ints(buf, start_ends + 1, line_ends)
+    regions = np.stack((starts, ends), axis=1)
+    # compare chrom names of consecutive lines to find where they change
+    name_lengths = chrom_ends - line_starts
+    if np.max(name_lengths) <= 8:
+        # compare names as the masked first eight bytes of each line
+        words = np.lib.stride_tricks.sliding_window_view(buf, 8)[line_starts]
+        names = words.copy().view(np.uint64)[:, 0] & _NAME_MASKS[name_lengths]
+        changes = np.flatnonzero(names[1:] != names[:-1]) + 1
+    else:
+        width = int(np.max(name_lengths))
+        names = np.lib.stride_tricks.sliding_window_view(buf, width)[line_starts]
+        names = names * (np.arange(width) < name_lengths[:, None])
+        changes = np.flatnonzero(np.any(names[1:] != names[:-1], axis=1)) + 1
+    changes = np.concatenate(([0], changes))
+    labels = [
+        (int(i), bytes(buf[line_starts[i]:chrom_ends[i]]).decode())
+        for i in changes
+    ]
+    # every digit outside chrom names must belong to a start or end field
+    num_digits = len(data) - len(data.translate(None, _DIGITS))
+    run_lengths = np.diff(np.append(changes, len(line_starts)))
+    chrom_digits = sum(
+        (len(chromnum) - len(chromnum.encode().translate(None, _DIGITS))) * k
+        for (i, chromnum), k in zip(labels, run_lengths)
+    )
+    field_digits = np.sum(start_ends - chrom_ends - 1) \
+        + np.sum(line_ends - start_ends - 1)
+    if num_digits != chrom_digits + field_digits:
+        raise ValueError("encountered a malformed integer field")
+
+    return regions, labels
+
+
+def _parse_bedfile(file):
+    """
+    Parse the regions in a .bed file in one pass, reading and parsing large
+    chunks of bytes at once. Returns an array of regions and a list of
+    (chromnum, first row, last row + 1) blocks, one for each run of consecutive
+    lines sharing a chromosome.
+    """
+    region_arrs = []
+    blocks = []
+    chromnum = None
+    num_rows = 0
+    for data in _iter_line_chunks(file):
+        regions, labels = _parse_bed_chunk(data)
+        for i, _chromnum in labels:
+            if _chromnum != chromnum:
+                if chromnum is not None:
+                    blocks.append((chromnum, lo, num_rows + i))
+                chromnum = _chromnum
+                lo = num_rows + i
+        region_arrs.append(regions)
+        num_rows += len(regions)
+    if chromnum is not None:
+        blocks.append((chromnum, lo, num_rows))
+    region_arr = np.concatenate(
+        [np.zeros((0, 2), dtype=np.int64)] + region_arrs
+    )
+
+    return region_arr, blocks
+
+
+def read_bedfile(file):
+    """
+    Read a .bed file and return an array of regions and the chromosome number,
+    represented as a string. For files holding several chromosomes, use
+    `RegionStore` instead.
+    """
+    region_arr, blocks = _parse_bedfile(file)
+    chromnum = blocks[-1][0] if blocks else None
 
     return region_arr, chromnum
 
 
-def write_bedfile(file, regions, chromnum):
+def _find_chrom_changes(data):
     """
-    write a .bed file (supports .gz) from an array of mask regions.
+    Find the lines in a bytes object holding complete lines of a .bed file
+    where the chromosome differs from the line before. Empty lines and lines
+    starting with `#` are ignored. Returns a list of (byte offset, chromnum)
+    pairs.
     """
-    openfunc = gzip.open if file.endswith(".gz") else open 
-    with openfunc(file, "wb") as fout:
-        for start, end in regions:
-            lineb = f"{chromnum}\t{start}\t{end}\n".encode()
-            fout.write(lineb)
+    buf = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == 10)
+    line_starts = np.concatenate(([0], newlines[:-1] + 1))
+    line_starts = line_starts[(buf[line_starts] > 32) & (buf[line_starts] != 35)]
+    if len(line_starts) == 0:
+        return []
+    # names end at the first whitespace byte of each line
+    delims = np.flatnonzero(buf <= 32)
+    name_ends = delims[np.searchsorted(delims, line_starts)]
+    name_lengths = name_ends - line_starts
+    width = int(np.max(name_lengths))
+    padded = np.frombuffer(data + bytes(width), dtype=np.uint8)
+    names = np.lib.stride_tricks.sliding_window_view(padded, width)[line_starts]
+    names = names * (np.arange(width) < name_lengths[:, None])
+    changes = np.flatnonzero(np.any(names[1:] != names[:-1], axis=1)) + 1
+    changes = np.concatenate(([0], changes))
+
+    return [
+        (int(line_starts[i]), bytes(buf[line_starts[i]:name_ends[i]]).decode())
+        for i in changes
+    ]
+
+
+def _build_bed_index(file):
+    """
+    Find the byte ranges of the runs of consecutive lines sharing a chromosome
+    in an uncompressed .bed file. Returns a list of (chromnum, offset, length)
+    tuples.
+    """
+    runs = []
+    offset = 0
+    for data in _iter_line_chunks(file):
+        for i, chromnum in _find_chrom_changes(data):
+            if len(runs) == 0 or chromnum != runs[-1][0]:
+                runs.append((chromnum, offset + i))
+        offset += len(data)
+    ends = [lo for _, lo in runs[1:]] + [os.path.getsize(file)]
+
+    return [(chromnum, lo, hi - lo) for (chromnum, lo), hi in zip(runs, ends)]
+
+
+def _read_bed_index(file):
+    ranges = []
+    with open(file, "r") as fin:
+        for line in fin:
+            chromnum, offset, length = line.split()
+            ranges.append((chromnum, int(offset), int(length)))
+    return ranges
+
+
+def is_stale(file, *inputs):
+    """
+    Check whether a derived file is missing or older than any of its inputs.
+    """
+    if not os.path.exists(file):
+        return True
+    mtime = os.path.getmtime(file)
+
+    return any(os.path.getmtime(inp) > mtime for inp in inputs)
+
+
+def load_bed_index(file):
+    """
+    Get the byte ranges of the chromosomes in an uncompressed .bed file, as a
+    list of (chromnum, offset, length) tuples. The index is read from
+    `{file}.bci` if present and newer than the file, and otherwise built in
+    one pass and written there.
+    """
+    index_file = file + ".bci"
+    if not is_stale(index_file, file):
+        return _read_bed_index(index_file)
+    ranges = _build_bed_index(file)
+    with open(index_file, "w") as fout:
+        for fields in ranges:
+            fout.write("\t".join(map(str, fields)) + "\n")
+
+    return ranges
+
+
+def _read_bed_ranges(file, ranges):
+    """
+    Parse the lines of an uncompressed .bed file in the given (chromnum,
+    offset, length) byte ranges. Returns an array of regions and a list of
+    (chromnum, first row, last row + 1) blocks, one for each range.
+    """
+    region_arrs = []
+    blocks = []
+    num_rows = 0
+    with open(file, "rb") as fin:
+        for chromnum, offset, length in ranges:
+            fin.seek(offset)
+            data = fin.read(length)
+            if not data.endswith(b"\n"):
+                # the final line lacks a newline
+                data += b"\n"
+            regions, _ = _parse_bed_chunk(data)
+            region_arrs.append(regions)
+            blocks.append((chromnum, num_rows, num_rows + len(regions)))
+            num_rows += len(regions)
+    region_arr = np.concatenate(
+        [np.zeros((0, 2), dtype=np.int64)] + region_arrs
+    )
+
+    return region_arr, blocks
+
+
+class RegionStore:
+    """
+    The regions in a multi-chromosome .bed file, indexed by chromosome. The file
+    is read in a single pass and regions on each chromosome are accessed as
+    views into one shared array. When only some chromosomes are loaded from an
+    uncompressed file, just their lines are read, through a byte index of the
+    chromosomes in the file.
+    """
+
+    def __init__(self, regions, index):
+        self.regions = regions
+        self.index = index
+
+    @classmethod
+    def from_bedfile(cls, file, chroms=None):
+        """
+        Load a .bed file (supports .gz) holding any number of chromosomes, or
+        only the chromosomes in `chroms`. For uncompressed files, the lines
+        of those chromosomes are located with `load_bed_index`, so the rest
+        of the file is never read. Compressed files are parsed in full.
+        """
+        if chroms is not None and not file.endswith(".gz"):
+            ranges = [
+                fields for fields in load_bed_index(file) if fields[0] in chroms
+            ]
+            regions, blocks = _read_bed_ranges(file, ranges)
+        else:
+            regions, blocks = _parse_bedfile(file)
+            if chroms is not None:
+                blocks = [block for block in blocks if block[0] in chroms]
+        rows = {}
+        for chromnum, lo, hi in blocks:
+            rows.setdefault(chromnum, []).append(np.arange(lo, hi))
+        num_rows = sum(hi - lo for _, lo, hi in blocks)
+        if len(rows) < len(blocks) or num_rows < len(regions):
+            # lines are not grouped by chromosome, or some were left out, so
+            # gather the rows of each chromosome
+            regions = regions[np.concatenate(
+                [np.arange(0)]
+                + [np.concatenate(chrom_rows) for chrom_rows in rows.values()]
+            )]
+        index = {}
+        lo = 0
+        for chromnum, chrom_rows in rows.items():
+            hi = lo + sum(len(r) for r in chrom_rows)
+            index[chromnum] = (lo, hi)
+            lo = hi
+
+        return cls(regions, index)
+
+    @property
+    def chroms(self):
+        return list(self.index)
+
+    def __contains__(self, chromnum):
+        return chromnum in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, chromnum):
+        """
+        Get the array of regions on chromosome `chromnum`.
+        """
+        if chromnum not in self.index:
+            raise KeyError(f"chromosome {chromnum} is not present")
+        lo, hi = self.index[chromnum]
+
+        return self.regions[lo:hi]
+
+
+# bytes searched for the CHROM and POS fields at the start of .vcf lines
+_VCF_PREFIX_SIZE = 64
+
+
+def _parse_vcf_chunk(data):
+    """
+    Parse the CHROM and POS columns of the complete .vcf lines held in a bytes
+    object, skipping header lines. Only a short prefix of each line is read.
+    Returns the chrom of the first record (or None) and an array of positions.
+    """
+    width = _VCF_PREFIX_SIZE
+    while True:
+        buf = np.frombuffer(
+            bytes(_PAD_SIZE) + data + bytes(width), dtype=np.uint8
+        )
+        newlines = np.flatnonzero(buf == 10)
+        line_starts = np.concatenate(([_PAD_SIZE], newlines[:-1] + 1))
+        line_starts = line_starts[buf[line_starts] != 35]
+        if len(line_starts) == 0:
+            return None, np.zeros(0, dtype=np.int64)
+        rows = np.lib.stride_tricks.sliding_window_view(buf, width)[line_starts]
+        is_tab = rows == 9
+        first = np.argmax(is_tab, axis=1)
+        is_tab[np.arange(len(rows)), first] = False
+        second = np.argmax(is_tab, axis=1)
+        failed = second <= first
+        if not np.any(failed):
+            break
+        # some prefixes hold fewer than two tabs, so widen them to whole lines
+        line_ends = newlines[np.searchsorted(newlines, line_starts[failed])]
+        longest = int(np.max(line_ends - line_starts[failed])) + 1
+        if longest <= width:
+            raise ValueError("encountered a line with fewer than three fields")
+        width = longest
+    cols = np.arange(width)
+    in_pos = (cols > first[:, None]) & (cols < second[:, None])
+    if np.any(in_pos & (rows - np.uint8(48) > 9)) or np.any(second - first < 2):
+        raise ValueError("encountered a malformed POS field")
+    positions = _parse_ints(buf, line_starts + first + 1, line_starts + second)
+    chromnum = bytes(buf[line_starts[0]:line_starts[0] + first[0]]).decode()
+
+    return chromnum, positions
+
+
+def iter_vcf_positions(file):
+    """
+    Read the POS column of a .vcf file (supports .gz) in large chunks, without
+    splitting lines in Python. Yields (chromnum, positions) pairs, where
+    chromnum is the CHROM of the first record in the chunk.
+    """
+    for data in _iter_line_chunks(file):
+        chromnum, positions = _parse_vcf_chunk(data)
+        if chromnum is not None:
+            yield chromnum, positions
+
+
+def read_vcf_positions(file):
+    """
+    Read the POS column of a single-chromosome .vcf file (supports .gz) into an
+    array. Returns the array and the chromosome number, represented as a string.
+    """
+    chromnum = None
+    arrs = [np.zeros(0, dtype=np.int64)]
+    for chromnum, positions in iter_vcf_positions(file):
+        arrs.append(positions)
+
+    return np.concatenate(arrs), chromnum
+
+
+# whether each ASCII code denotes a high-confidence (upper case) state
+_IS_HIGH_CONFIDENCE = np.zeros(256, dtype=bool)
+_IS_HIGH_CONFIDENCE[np.frombuffer(b"ACGT", dtype=np.uint8)] = True
+
+
+def is_high_confidence(states):
+    """
+    Check whether each state, given as a uint8 ASCII code, is a nucleotide
+    assigned with high confidence.
+    """
+    return _IS_HIGH_CONFIDENCE[states]
+
+
+def read_pop_file(file, pops=None):
+    """
+    Load a whitespace-separated file mapping samples to populations, with one
+    SAMPLE POPULATION pair on each line. Returns a dict mapping populations to
+    lists of sample ids, restricted to and ordered as `pops` if it is given.
+    """
+    pop_mapping = {}
+    with open(file, "r") as fin:
+        for line in fin:
+            if line.isspace():
+                continue
+            sample_id, pop = line.split()
+            pop_mapping.setdefault(pop, []).append(sample_id)
+    if pops is not None:
+        pop_mapping = {pop: pop_mapping[pop] for pop in pops}
+
+    return pop_mapping
+
+
+def _get_sample_columns(header, pop_mapping):
+    """
+    Get the .vcf sample column of each sample in `pop_mapping`, grouped by
+    population, from the #CHROM header line of a .vcf file. Also returns the
+    number of samples in the .vcf file.
+    """
+    sample_ids = header.decode().split()[9:]
+    columns = []
+    for samples in pop_mapping.values():
+        for sample_id in samples:
+            if sample_id not in sample_ids:
+                raise ValueError(f"sample {sample_id} is absent from .vcf")
+            columns.append(sample_ids.index(sample_id))
+
+    return np.array(columns, dtype=np.int64), len(sample_ids)
+
+
+def _split_vcf_header(data):
+    """
+    Split a chunk of .vcf lines after its #CHROM header line. Returns the header
+    line, or None if the chunk lacks it, and the lines that follow it.
+    """
+    if data.startswith(b"#CHROM"):
+        start = 0
+    else:
+        start = data.find(b"\n#CHROM") + 1
+        if start == 0:
+            return None, b""
+    end = data.index(b"\n", start) + 1
+
+    return data[start:end], data[end:]
+
+
+def _gather_bytes(buf, starts, width):
+    # the `width` bytes following each start, as rows of a matrix
+    return np.lib.stride_tricks.sliding_window_view(buf, width)[starts]
+
+
+def _parse_genotype_chunk(data, columns, num_samples):
+    """
+    Parse the complete .vcf records held in a bytes object into columns,
+    without splitting lines in Python. Tabs are located once and fields are
+    addressed through them. `columns` selects the samples whose GT fields are
+    decoded; GT must be the first FORMAT field, as the .vcf format requires.
+
+    Returns the chrom of the first record (or None) and a dict of arrays with
+    one entry per record: `positions`, the `ref` and `alt` bytes (0 unless
+    the allele is a single character), the `anc` byte of INFO/AA (0 unless
+    it is a single character), whether FILTER is PASS or . (`passed`), a
+    uint8 (sites x haplotypes) matrix of `alleles` and a matching matrix of
+    whether each allele was `called`. Alleles are called when they are 0 or 1
+    within a diploid GT; others are counted as missing, and are set to 0.
+    """
+    if len(data) == 0:
+        return None, None
+    buf = np.frombuffer(bytes(_PAD_SIZE) + data + bytes(4), dtype=np.uint8)
+    newlines = np.flatnonzero(buf == 10)
+    line_starts = np.concatenate(([_PAD_SIZE], newlines[:-1] + 1))
+    is_record = buf[line_starts] != 35
+    line_starts = line_starts[is_record]
+    line_ends = newlines[is_record]
+    if len(line_starts) == 0:
+        return None, None
+    num_fields = 9 + num_samples
+    tabs = np.flatnonzero(buf == 9)
+    lo = np.searchsorted(tabs, line_starts)
+    if np.any(np.searchsorted(tabs, line_ends) - lo != num_fields - 1):
+        raise ValueError(f"encountered a line without {num_fields} fields")
+    # field k of each record spans [starts[:, k], tabs[:, k])
+    tabs = tabs[lo[:, None] + np.arange(num_fields - 1)]
+    starts = np.column_stack((line_starts, tabs[:, :9] + 1))
+    lengths = tabs[:, :9] - starts[:, :9]
+
+    width = int(lengths[0, 0])
+    names = _gather_bytes(buf, starts[:, 0], width)
+    if np.any(lengths[:, 0] != width) or np.any(names != names[0]):
+        raise ValueError(".vcf file must record only one chromosome")
+    chromnum = bytes(names[0]).decode()
+    width = int(np.max(lengths[:, 1]))
+    digits = _gather_bytes(buf, tabs[:, 0] + 1 - width + lengths[:, 1], width)
+    in_pos = np.arange(width) >= width - lengths[:, 1, None]
+    if np.any(in_pos & (digits - np.uint8(48) > 9)) \
+            or np.any(lengths[:, 1] < 1):
+        raise ValueError("encountered a malformed POS field")
+    positions = _parse_ints(buf, starts[:, 1], tabs[:, 1])
+
+    ref = np.where(lengths[:, 3] == 1, buf[starts[:, 3]], 0)
+    alt = np.where(lengths[:, 4] == 1, buf[starts[:, 4]], 0)
+    filters = _gather_bytes(buf, starts[:, 6], 4)
+    is_pass = np.all(filters == np.frombuffer(b"PASS", dtype=np.uint8), axis=1)
+    passed = ((lengths[:, 6] == 4) & is_pass) \
+        | ((lengths[:, 6] == 1) & (filters[:, 0] == ord(".")))
+    # find AA=X items in INFO fields
+    hits = np.flatnonzero(
+        (buf[:-4] == ord("A")) & (buf[1:-3] == ord("A"))
+        & (buf[2:-2] == ord("="))
+    )
+    rows = np.searchsorted(line_starts, hits, side="right") - 1
+    hits_info = (hits >= starts[rows, 7]) & (hits < tabs[rows, 7]) \
+        & ((hits == starts[rows, 7]) | (buf[hits - 1] == ord(";")))
+    hits, rows = hits[hits_info], rows[hits_info]
+    anc = np.zeros(len(line_starts), dtype=np.uint8)
+    single = (buf[hits + 4] == ord(";")) | (buf[hits + 4] == 9)
+    anc[rows] = np.where(single, buf[hits + 3], 0)
+
+    formats = _gather_bytes(buf, starts[:, 8], 3)
+    if np.any((formats[:, 0] != ord("G")) | (formats[:, 1] != ord("T"))
+              | ((formats[:, 2] != ord(":")) & (formats[:, 2] != 9))):
+        raise ValueError("GT must be the first FORMAT field")
+    gts = _gather_bytes(buf, tabs[:, 8 + columns] + 1, 4)
+    alleles = gts[:, :, [0, 2]] - np.uint8(48)
+    seps = gts[:, :, 1]
+    ends = gts[:, :, 3]
+    diploid = ((seps == ord("/")) | (seps == ord("|"))) \
+        & ((ends == ord(":")) | (ends == 9) | (ends == 10))
+    called = (alleles <= 1) & diploid[:, :, None]
+    alleles[~called] = 0
+    cols = {
+        "positions": positions,
+        "ref": ref,
+        "alt": alt,
+        "anc": anc,
+        "passed": passed,
+        "alleles": alleles.reshape(len(line_starts), -1),
+        "called": called.reshape(len(line_starts), -1),
+    }
+
+    return chromnum, cols
+
+
+# number of spectrum entries built at once when projecting sites
+_PROJECT_BATCH = 1 << 22
+
+
+@functools.lru_cache(maxsize=None)
+def _projection_weights(n, m):
+    """
+    Get the hypergeometric weights for projecting sites from sample size `n`
+    down to `m`, as a matrix whose row d holds the probabilities of drawing
+    0, ..., m derived alleles when d of the n sampled alleles are derived.
+    """
+    if m > n:
+        raise ValueError(f"cannot project sample size {n} up to {m}")
+    weights = np.array([
+        [math.comb(d, j) * math.comb(n - d, m - j) for j in range(m + 1)]
+        for d in range(n + 1)
+    ], dtype=np.float64)
+
+    return weights / math.comb(n, m)
+
+
+def _contract_sites(spectra, keys, values, proj_sizes, level):
+    """
+    Project the axes of populations 0, ..., `level` of tallied configurations.
+    `keys` holds a window column followed by (sample size, derived count)
+    column pairs of each population up to `level`, and `values` holds the
+    projected entries of the later populations. Each population's weights are
+    applied to configurations that are unique up to that population, which are
+    then summed over it, so the work shrinks as populations are projected.
+    Rows are handled in batches of at most `_PROJECT_BATCH` entries.
+    """
+    if level < 0:
+        spectra[keys[:, 0]] += values
+        return
+    m = proj_sizes[level]
+    batch = max(1, _PROJECT_BATCH // (values.shape[1] * (m + 1)))
+    for lo in range(0, len(keys), batch):
+        block = keys[lo:lo + batch]
+        ns = block[:, 1 + 2 * level]
+        ds = block[:, 2 + 2 * level]
+        weights = np.empty((len(block), m + 1))
+        for n in np.unique(ns):
+            at_n = ns == n
+            weights[at_n] = _projection_weights(int(n), m)[ds[at_n]]
+        entries = weights[:, :, None] * values[lo:lo + batch, None, :]
+        entries = entries.reshape(len(block), -1)
+        # configurations are sorted, so those sharing a prefix are adjacent
+        prefixes = block[:, :1 + 2 * level]
+        firsts = np.flatnonzero(
+            np.any(np.diff(prefixes, axis=0, prepend=-1) != 0, axis=1)
+        )
+        _contract_sites(
+            spectra, prefixes[firsts], np.add.reduceat(entries, firsts, axis=0),
+            proj_sizes, level - 1
+        )
+
+    return
+
+
+def _add_projected_sites(spectra, idx, sizes, derived, proj_sizes,
+                         weights=None):
+    """
+    Add sites to a flattened stack of projected spectra, without building the
+    spectra at their full sample sizes. Sites, or entries with `weights`, are
+    tallied into unique (window, sample size, derived count) configurations.
+    Populations are projected from the largest projected size to the
+    smallest, which keeps the number of distinct configurations low when the
+    largest entries are formed.
+    """
+    order = np.argsort(proj_sizes, kind="stable")
+    keys = np.column_stack(
+        [idx] + [col for i in order for col in (sizes[:, i], derived[:, i])]
+    )
+    if len(keys) == 0:
+        return
+    keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(keys))
+    sorted_sizes = [proj_sizes[i] for i in order]
+    contracted = np.zeros(spectra.shape)
+    _contract_sites(
+        contracted, keys, counts[:, None].astype(np.float64), sorted_sizes,
+        len(order) - 1
+    )
+    # restore the order of populations
+    contracted = contracted.reshape(-1, *(m + 1 for m in sorted_sizes))
+    spectra += contracted.transpose(0, *(np.argsort(order) + 1)).reshape(
+        spectra.shape
+    )
+
+    return
+
+
+def _iter_site_counts(vcf_file, pop_mapping, bed_file=None):
+    """
+    Read a single-chromosome .vcf file (supports .gz) in chunks, keeping sites
+    as moments.Spectrum.from_vcf does with `use_AA=True`: only biallelic SNPs
+    with a high-confidence ancestral allele matching REF or ALT. If `bed_file`
+    is given, only sites within its regions are kept. Yields the chrom and a
+    dict of arrays with one entry per kept site: `positions`, the `anc` byte,
+    whether FILTER is PASS or . (`passed`), and (sites x populations) matrices
+    of called allele counts (`sizes`) and `derived` allele counts, summed over
+    the allele matrix columns of each population.
+    """
+    if bed_file is not None:
+        regions, _ = read_bedfile(bed_file)
+        # sorted and disjoint, so that positions are found by binary search
+        merged = merge_regions(regions)
+    full_sizes = [2 * len(samples) for samples in pop_mapping.values()]
+    # the first haplotype column of each population
+    offsets = np.concatenate(([0], np.cumsum(full_sizes)[:-1]))
+    columns = None
+    vcf_chrom = None
+    for data in _iter_line_chunks(vcf_file):
+        if columns is None:
+            header, data = _split_vcf_header(data)
+            if header is None:
+                continue
+            columns, num_samples = _get_sample_columns(header, pop_mapping)
+        chromnum, cols = _parse_genotype_chunk(data, columns, num_samples)
+        if chromnum is None:
+            continue
+        if vcf_chrom is not None and chromnum != vcf_chrom:
+            raise ValueError(".vcf file must record only one chromosome")
+        vcf_chrom = chromnum
+        positions = cols["positions"]
+        keep = np.ones(len(positions), dtype=bool)
+        if bed_file is not None:
+            # the only region that can hold a site is the first one ending
+            # after its 0-indexed position
+            k = np.searchsorted(merged[:, 1], positions - 1, side="right")
+            keep &= k < len(merged)
+            keep[keep] = merged[k[keep], 0] <= positions[keep] - 1
+        ref, alt, anc = cols["ref"], cols["alt"], cols["anc"]
+        keep &= (ref > 0) & (alt > 0) & is_high_confidence(anc)
+        keep &= (anc == ref) | (anc == alt)
+        sizes = np.add.reduceat(
+            cols["called"][keep], offsets, axis=1, dtype=np.int64
+        )
+        alt_counts = np.add.reduceat(
+            cols["alleles"][keep], offsets, axis=1, dtype=np.int64
+        )
+        derived = np.where(
+            (anc == ref)[keep, None], alt_counts, sizes - alt_counts
+        )
+        yield chromnum, {
+            "positions": positions[keep],
+            "anc": anc[keep],
+            "passed": cols["passed"][keep],
+            "sizes": sizes,
+            "derived": derived,
+        }
+
+
+def _tally_spectra(site_chunks, pop_ids, full_sizes, windows=None,
+                   sample_sizes=None, pass_only=False, sparse=False,
+                   complete_only=False):
+    """
+    Tally the spectra of windows from chunks of sites, given as dicts holding
+    `positions`, `passed`, and (sites x populations) matrices of called allele
+    counts (`sizes`) and `derived` allele counts. Arguments and return values
+    are as in `parse_vcf_sfs`.
+    """
+    if windows is None:
+        windows = np.array([1, np.iinfo(np.int64).max])
+    windows = np.asarray(windows, dtype=np.int64)
+    num_windows = len(windows) - 1
+    full_sizes = np.asarray(full_sizes, dtype=np.int64)
+    if sample_sizes is None:
+        proj_sizes = None
+        out_sizes = full_sizes
+    else:
+        proj_sizes = [int(m) for m in sample_sizes]
+        if len(proj_sizes) != len(full_sizes):
+            raise ValueError("expected one sample size for each population")
+        if np.any(np.array(proj_sizes) > full_sizes):
+            raise ValueError("sample sizes exceed those of the data")
+        out_sizes = np.array(proj_sizes)
+    shape = (num_windows, *(out_sizes + 1))
+    if sparse and proj_sizes is None:
+        # flat indices of the nonzero entries and their counts, and those of
+        # chunks that are yet to be merged into them
+        tally = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        pending = []
+    else:
+        spectra = np.zeros((num_windows, np.prod(shape[1:])))
+    num_sites = np.zeros(num_windows, dtype=np.int64)
+    for cols in site_chunks:
+        idx = np.searchsorted(windows, cols["positions"], side="right") - 1
+        keep = (idx >= 0) & (idx < num_windows)
+        if pass_only:
+            keep &= cols["passed"]
+        idx = idx[keep]
+        sizes = cols["sizes"][keep]
+        derived = cols["derived"][keep]
+        num_sites += np.bincount(idx, minlength=num_windows)
+        if proj_sizes is None:
+            complete = np.all(sizes == full_sizes, axis=1)
+            flat = np.ravel_multi_index(
+                (idx[complete], *derived[complete].T), shape
+            )
+            if sparse:
+                pending.append(np.unique(flat, return_counts=True))
+                # merging once pending entries outnumber the tally keeps the
+                # cost of merging linear in the number of chunks
+                if sum(len(p[0]) for p in pending) > len(tally[0]):
+                    tally = _merge_tallies([tally] + pending)
+                    pending = []
+            else:
+                spectra += np.bincount(flat, minlength=spectra.size).reshape(
+                    spectra.shape
+                )
+        else:
+            if complete_only:
+                enough = np.all(sizes == full_sizes, axis=1)
+            else:
+                enough = np.all(sizes >= out_sizes, axis=1)
+            _add_projected_sites(
+                spectra, idx[enough], sizes[enough], derived[enough],
+                proj_sizes
+            )
+    if sparse:
+        size = np.prod(shape[1:])
+        if proj_sizes is None:
+            index, counts = _merge_tallies([tally] + pending)
+            bounds = np.searchsorted(index, np.arange(num_windows + 1) * size)
+            spectra = [
+                SparseSpectrum(
+                    index[lo:hi] - i * size, counts[lo:hi], shape[1:], pop_ids
+                )
+                for i, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:]))
+            ]
+        else:
+            spectra = [
+                SparseSpectrum(np.flatnonzero(row), row[row != 0], shape[1:],
+                               pop_ids)
+                for row in spectra
+            ]
+    else:
+        spectra = spectra.reshape(shape)
+
+    return spectra, num_sites
+
+
+def parse_vcf_sfs(vcf_file, pop_mapping, windows=None, bed_file=None,
+                  sample_sizes=None, pass_only=False, sparse=False,
+                  complete_only=False):
+    """
+    Compute unfolded spectra from a single-chromosome .vcf file (supports .gz)
+    in one pass, polarizing alleles with INFO/AA. Sites are filtered as in
+    moments.Spectrum.from_vcf with `use_AA=True`: only biallelic SNPs with a
+    high-confidence ancestral allele matching REF or ALT are counted. If
+    `pass_only` is True, sites must also have FILTER PASS or `.`.
+
+    Records are decoded in chunks into a matrix of alleles, whose columns are
+    summed within populations to get derived allele counts. The counts are
+    tallied with np.bincount on their raveled multi-index.
+
+    `sample_sizes` optionally gives a haploid sample size for each population
+    in `pop_mapping`. Sites are then projected down to these sizes as they are
+    parsed, using cached hypergeometric weights, so that spectra are never
+    held at the full sample sizes. Sites with missing genotypes are projected
+    when enough alleles are called, as in from_vcf; otherwise they are
+    skipped. If `complete_only` is True, only sites without missing genotypes
+    are projected, as when a spectrum parsed at full sample sizes is
+    projected afterwards with moments.Spectrum.project.
+
+    `windows` is a sorted array of 1-indexed window edges; site positions are
+    assigned to the half-open windows between consecutive edges with
+    searchsorted, and sites outside them are ignored. If `bed_file` is given,
+    only sites within its regions are counted. Returns an array holding one
+    spectrum per window, with shape (num_windows, n_1 + 1, ..., n_k + 1), and
+    the number of sites counted in each window, including those with missing
+    genotypes. If `sparse` is True, spectra are instead returned as a list of
+    `SparseSpectrum`, and spectra at full sample sizes are only ever held as
+    their nonzero entries.
+    """
+    site_chunks = (
+        cols for _, cols in _iter_site_counts(vcf_file, pop_mapping, bed_file)
+    )
+
+    return _tally_spectra(
+        site_chunks,
+        list(pop_mapping.keys()),
+        [2 * len(samples) for samples in pop_mapping.values()],
+        windows=windows,
+        sample_sizes=sample_sizes,
+        pass_only=pass_only,
+        sparse=sparse,
+        complete_only=complete_only,
+    )
+
+
+def _sum_duplicates(index, values):
+    """
+    Sort an array of flat indices, summing the values of repeated indices.
+    """
+    index, inverse = np.unique(index, return_inverse=True)
+    summed = np.bincount(inverse.ravel(), weights=values, minlength=len(index))
+
+    return index, summed.astype(values.dtype)
+
+
+def _merge_tallies(tallies):
+    # merge (index, values) pairs into one, summing values of shared indices
+    return _sum_duplicates(
+        np.concatenate([index for index, _ in tallies]),
+        np.concatenate([values for _, values in tallies])
+    )
+
+
+# identifies binary site count caches
+_COUNTS_MAGIC = b"CNT1"
+
+# number of cached sites tallied at once
+_COUNTS_ROWS = 1 << 20
+
+
+class SiteCounts:
+    """
+    A columnar cache of the sites of one chromosome that are counted in
+    spectra, as kept by `parse_vcf_sfs`: their 1-indexed `positions`, the
+    `anc` byte of INFO/AA, whether FILTER is PASS or . (`passed`), and
+    (sites x populations) matrices of called allele counts (`sizes`) and
+    `derived` allele counts. Caches are built with one pass over a .vcf file
+    and memory-mapped when loaded, so that spectra of any subset of
+    populations, projection or windows are computed without re-reading it.
+    """
+
+    def __init__(self, chromnum, pop_ids, full_sizes, positions, anc, passed,
+                 sizes, derived):
+        self.chromnum = chromnum
+        self.pop_ids = list(pop_ids)
+        self.full_sizes = [int(n) for n in full_sizes]
+        self.positions = positions
+        self.anc = anc
+        self.passed = passed
+        self.sizes = sizes
+        self.derived = derived
+
+    def __len__(self):
+        return len(self.positions)
+
+    @classmethod
+    def from_vcf(cls, vcf_file, pop_mapping, bed_file=None):
+        """
+        Count the alleles of every population in `pop_mapping` at the sites of
+        a single-chromosome .vcf file, which are restricted to the regions of
+        `bed_file` if it is given.
+        """
+        full_sizes = [2 * len(samples) for samples in pop_mapping.values()]
+        if max(full_sizes) > np.iinfo(np.uint16).max:
+            raise ValueError("sample sizes are too large to cache")
+        chromnum = None
+        chunks = []
+        for chromnum, cols in _iter_site_counts(vcf_file, pop_mapping, bed_file):
+            cols["sizes"] = cols["sizes"].astype(np.uint16)
+            cols["derived"] = cols["derived"].astype(np.uint16)
+            chunks.append(cols)
+        num_pops = len(full_sizes)
+        empty = {
+            "positions": np.zeros(0, dtype=np.int64),
+            "anc": np.zeros(0, dtype=np.uint8),
+            "passed": np.zeros(0, dtype=bool),
+            "sizes": np.zeros((0, num_pops), dtype=np.uint16),
+            "derived": np.zeros((0, num_pops), dtype=np.uint16),
+        }
+        columns = {
+            key: np.concatenate([empty[key]] + [cols[key] for cols in chunks])
+            for key in empty
+        }
+
+        return cls(chromnum or "", pop_mapping.keys(), full_sizes, **columns)
+
+    def save(self, file):
+        """
+        Write the cache to a binary file: a header holding the chrom, pop_ids
+        and sample sizes, then the positions, the count matrices, the
+        ancestral alleles and the FILTER flags.
+        """
+        chromnum = self.chromnum.encode()
+        pop_ids = "\t".join(self.pop_ids).encode()
+        header = b"".join([
+            _COUNTS_MAGIC,
+            np.array(
+                [len(self.pop_ids), len(chromnum), len(pop_ids)], dtype="<u4"
+            ).tobytes(),
+            np.array([len(self), *self.full_sizes], dtype="<u8").tobytes(),
+            chromnum,
+            pop_ids,
+        ])
+        with open(file, "wb") as fout:
+            fout.write(header + bytes(_pad_to(len(header))))
+            fout.write(np.asarray(self.positions, dtype="<i8").tobytes())
+            fout.write(np.asarray(self.sizes, dtype="<u2").tobytes())
+            fout.write(np.asarray(self.derived, dtype="<u2").tobytes())
+            fout.write(np.asarray(self.anc, dtype=np.uint8).tobytes())
+            fout.write(np.asarray(self.passed, dtype=np.uint8).tobytes())
+        return
+
+    @classmethod
+    def load(cls, file):
+        """
+        Memory-map a cache written by `save`.
+        """
+        data = np.memmap(file, dtype=np.uint8, mode="r")
+        if bytes(data[:4]) != _COUNTS_MAGIC:
+            raise ValueError(f"{file} is not a site count cache")
+        num_pops, chrom_len, ids_len = data[4:16].view("<u4").tolist()
+        offset = 16
+        num_sites, *full_sizes = data[offset:offset + 8 * (num_pops + 1)] \
+            .view("<u8").tolist()
+        offset += 8 * (num_pops + 1)
+        chromnum = bytes(data[offset:offset + chrom_len]).decode()
+        offset += chrom_len
+        pop_ids = bytes(data[offset:offset + ids_len]).decode().split("\t")
+        offset += ids_len
+        offset += _pad_to(offset)
+        positions = data[offset:offset + 8 * num_sites].view("<i8")
+        offset += 8 * num_sites
+        size = 2 * num_sites * num_pops
+        sizes = data[offset:offset + size].view("<u2").reshape(-1, num_pops)
+        offset += size
+        derived = data[offset:offset + size].view("<u2").reshape(-1, num_pops)
+        offset += size
+        anc = data[offset:offset + num_sites]
+        offset += num_sites
+        passed = data[offset:offset + num_sites].view(bool)
+
+        return cls(
+            chromnum, pop_ids, full_sizes, positions, anc, passed, sizes,
+            derived
+        )
+
+    def spectra(self, pops=None, windows=None, sample_sizes=None,
+                pass_only=False, sparse=False, complete_only=False):
+        """
+        Compute the spectra of `pops`, which default to all cached populations,
+        from the cached counts. Other arguments and return values are as in
+        `parse_vcf_sfs`; sites are read `_COUNTS_ROWS` at a time.
+        """
+        if pops is None:
+            pops = self.pop_ids
+        for pop in pops:
+            if pop not in self.pop_ids:
+                raise ValueError(f"population {pop} is absent from the cache")
+        cols = [self.pop_ids.index(pop) for pop in pops]
+        site_chunks = (
+            {
+                "positions": self.positions[lo:lo + _COUNTS_ROWS],
+                "passed": self.passed[lo:lo + _COUNTS_ROWS],
+                "sizes": self.sizes[lo:lo + _COUNTS_ROWS, cols]
+                    .astype(np.int64),
+                "derived": self.derived[lo:lo + _COUNTS_ROWS, cols]
+                    .astype(np.int64),
+            }
+            for lo in range(0, len(self), _COUNTS_ROWS)
+        )
+
+        return _tally_spectra(
+            site_chunks,
+            list(pops),
+            [self.full_sizes[i] for i in cols],
+            windows=windows,
+            sample_sizes=sample_sizes,
+            pass_only=pass_only,
+            sparse=sparse,
+            complete_only=complete_only,
+        )
+
+
+# identifies binary sparse spectrum files
+_SPECTRUM_MAGIC = b"SFS1"
+
+
+class SparseSpectrum:
+    """
+    A frequency spectrum held as the flat indices and values of its nonzero
+    entries (COO format), sorted by index. It supports addition,
+    marginalization and projection without ever building the dense array,
+    which is only formed by `to_spectrum` when a likelihood is needed. As in
+    moments, the corners of the spectrum are masked by default; their entries
+    are dropped.
+    """
+
+    def __init__(self, index, values, shape, pop_ids=None, mask_corners=True):
+        self.shape = tuple(int(n) for n in shape)
+        self.pop_ids = None if pop_ids is None else list(pop_ids)
+        self.mask_corners = mask_corners
+        index = np.asarray(index, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        keep = values != 0
+        if mask_corners:
+            keep &= (index != 0) & (index != np.prod(self.shape) - 1)
+        self.index = index[keep]
+        self.values = values[keep]
+
+    @property
+    def sample_sizes(self):
+        return [n - 1 for n in self.shape]
+
+    @property
+    def nnz(self):
+        return len(self.index)
+
+    def S(self):
+        """
+        Get the sum of the unmasked entries.
+        """
+        return float(np.sum(self.values))
+
+    @classmethod
+    def from_spectrum(cls, fs):
+        """
+        Convert a dense moments.Spectrum, whose mask may only cover its corners.
+        """
+        data = np.ma.getdata(fs).ravel()
+        masked = np.flatnonzero(np.ma.getmaskarray(fs).ravel())
+        if np.any((masked != 0) & (masked != len(data) - 1)):
+            raise ValueError("only spectra with masked corners are supported")
+        mask_corners = len(masked) > 0
+        index = np.flatnonzero(data)
+
+        return cls(index, data[index], fs.shape, fs.pop_ids, mask_corners)
+
+    def to_spectrum(self):
+        """
+        Build the dense moments.Spectrum.
+        """
+        import moments
+
+        data = np.zeros(self.shape)
+        data.flat[self.index] = self.values
+
+        return moments.Spectrum(
+            data, mask_corners=self.mask_corners, pop_ids=self.pop_ids
+        )
+
+    def _check_compatible(self, other):
+        if self.shape != other.shape:
+            raise ValueError("spectra have different shapes")
+        if self.pop_ids is not None and other.pop_ids is not None \
+                and self.pop_ids != other.pop_ids:
+            raise ValueError("spectra have different pop_ids")
+
+    def __add__(self, other):
+        if isinstance(other, (int, float)) and other == 0:
+            return self
+        self._check_compatible(other)
+        index, values = _sum_duplicates(
+            np.concatenate((self.index, other.index)),
+            np.concatenate((self.values, other.values))
+        )
+        pop_ids = self.pop_ids if self.pop_ids is not None else other.pop_ids
+
+        return SparseSpectrum(
+            index, values, self.shape, pop_ids,
+            self.mask_corners or other.mask_corners
+        )
+
+    __radd__ = __add__
+
+    def marginalize(self, axes):
+        """
+        Sum over the populations in `axes`.
+        """
+        keep = [i for i in range(len(self.shape)) if i not in axes]
+        coords = np.unravel_index(self.index, self.shape)
+        shape = [self.shape[i] for i in keep]
+        index = np.ravel_multi_index([coords[i] for i in keep], shape)
+        index, values = _sum_duplicates(index, self.values)
+        pop_ids = None
+        if self.pop_ids is not None:
+            pop_ids = [self.pop_ids[i] for i in keep]
+
+        return SparseSpectrum(index, values, shape, pop_ids, self.mask_corners)
+
+    def project(self, sample_sizes):
+        """
+        Project down to `sample_sizes` with hypergeometric weights. Only the
+        projected spectrum is built densely.
+        """
+        proj_sizes = [int(m) for m in sample_sizes]
+        if len(proj_sizes) != len(self.shape):
+            raise ValueError("expected one sample size for each population")
+        coords = np.column_stack(np.unravel_index(self.index, self.shape))
+        sizes = np.broadcast_to(self.sample_sizes, coords.shape)
+        projected = np.zeros((1, np.prod([m + 1 for m in proj_sizes])))
+        _add_projected_sites(
+            projected, np.zeros(self.nnz, dtype=np.int64), sizes, coords,
+            proj_sizes, weights=self.values
+        )
+        index = np.flatnonzero(projected[0])
+
+        return SparseSpectrum(
+            index, projected[0, index], [m + 1 for m in proj_sizes],
+            self.pop_ids, self.mask_corners
+        )
+
+    def save(self, file):
+        """
+        Write the spectrum to a binary file: a header holding the shape, the
+        corner mask flag and pop_ids, then the flat indices and the values.
+        """
+        pop_ids = b"" if self.pop_ids is None \
+            else "\t".join(self.pop_ids).encode()
+        with open(file, "wb") as fout:
+            fout.write(_SPECTRUM_MAGIC)
+            fout.write(np.array(
+                [len(self.shape), self.mask_corners, len(pop_ids)], dtype="<u4"
+            ).tobytes())
+            fout.write(np.array(self.shape, dtype="<u8").tobytes())
+            fout.write(pop_ids)
+            fout.write(np.array([self.nnz], dtype="<u8").tobytes())
+            fout.write(self.index.astype("<i8").tobytes())
+            fout.write(self.values.astype("<f8").tobytes())
+        return
+
+    @classmethod
+    def load(cls, file):
+        """
+        Memory-map a spectrum written by `save`.
+        """
+        data = np.memmap(file, dtype=np.uint8, mode="r")
+        if bytes(data[:4]) != _SPECTRUM_MAGIC:
+            raise ValueError(f"{file} is not a sparse spectrum file")
+        ndim, mask_corners, ids_len = data[4:16].view("<u4").tolist()
+        offset = 16
+        shape = data[offset:offset + 8 * ndim].view("<u8").tolist()
+        offset += 8 * ndim
+        pop_ids = bytes(data[offset:offset + ids_len]).decode().split("\t") \
+            if ids_len > 0 else None
+        offset += ids_len
+        nnz = int(data[offset:offset + 8].view("<u8")[0])
+        offset += 8
+        index = data[offset:offset + 8 * nnz].view("<i8")
+        offset += 8 * nnz
+        values = data[offset:offset + 8 * nnz].view("<f8")
+
+        return cls(index, values, shape, pop_ids, bool(mask_corners))
+
+
+def load_spectrum(file):
+    """
+    Load a spectrum as a `SparseSpectrum`, from either a binary sparse spectrum
+    file or a moments text .fs file.
+    """
+    with open(file, "rb") as fin:
+        magic = fin.read(len(_SPECTRUM_MAGIC))
+    if magic == _SPECTRUM_MAGIC:
+        return SparseSpectrum.load(file)
+    import moments
+
+    return SparseSpectrum.from_spectrum(moments.Spectrum.from_file(file))
+
+
+# identifies binary spectrum stack files
+_STACK_MAGIC = b"STK1"
+
+
+def _pad_to(n, size=8):
+    return -n % size
+
+
+class SpectrumStack:
+    """
+    A stack of spectra sharing a shape, a mask and pop_ids, such as the spectra
+    of genomic windows or bootstrap replicates. `data` has shape
+    (num_spectra, n_1 + 1, ..., n_k + 1); each spectrum has a label and a
+    sequence length `L`, which is NaN when unknown. Stacks are written to a
+    binary file whose data block is memory-mapped as a single array on loading.
+    """
+
+    def __init__(self, data, mask, pop_ids=None, labels=None, L=None):
+        self.data = data
+        self.mask = np.asarray(mask, dtype=bool)
+        if self.mask.shape != data.shape[1:]:
+            raise ValueError("mask and spectra have different shapes")
+        self.pop_ids = None if pop_ids is None else list(pop_ids)
+        if labels is None:
+            labels = [str(i) for i in range(len(data))]
+        self.labels = list(labels)
+        if L is None:
+            L = np.full(len(data), np.nan)
+        self.L = np.asarray(L, dtype=np.float64)
+        if len(self.labels) != len(data) or len(self.L) != len(data):
+            raise ValueError("expected one label and one L for each spectrum")
+
+    @property
+    def shape(self):
+        return self.data.shape[1:]
+
+    @property
+    def sample_sizes(self):
+        return [n - 1 for n in self.shape]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, i):
+        """
+        Get spectrum `i` as a moments.Spectrum.
+        """
+        import moments
+
+        return moments.Spectrum(
+            self.data[i], mask=self.mask, mask_corners=False,
+            pop_ids=self.pop_ids
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @classmethod
+    def from_spectra(cls, spectra, labels=None, L=None):
+        """
+        Stack a list of moments.Spectrum objects, which must share their mask
+        and pop_ids.
+        """
+        mask = np.ma.getmaskarray(spectra[0])
+        pop_ids = spectra[0].pop_ids
+        for fs in spectra[1:]:
+            if not np.array_equal(np.ma.getmaskarray(fs), mask):
+                raise ValueError("spectra have different masks")
+            if fs.pop_ids != pop_ids:
+                raise ValueError("spectra have different pop_ids")
+        data = np.stack([np.ma.getdata(fs) for fs in spectra])
+
+        return cls(data, mask, pop_ids, labels, L)
+
+    def sum(self):
+        """
+        Get the sum of all spectra as a moments.Spectrum.
+        """
+        import moments
+
+        return moments.Spectrum(
+            self.data.sum(axis=0), mask=self.mask, mask_corners=False,
+            pop_ids=self.pop_ids
+        )
+
+    def resample(self, counts, labels=None):
+        """
+        Form weighted sums of the spectra and of L, such as bootstrap
+        replicates, from a (num_sums x num_spectra) matrix of `counts`. All
+        sums are taken with one tensordot over the stacked spectra.
+        """
+        counts = np.asarray(counts)
+        if counts.ndim != 2 or counts.shape[1] != len(self):
+            raise ValueError("expected one column of counts for each spectrum")
+        data = np.tensordot(counts, self.data, axes=1)
+        L = counts @ self.L
+
+        return SpectrumStack(data, self.mask, self.pop_ids, labels=labels, L=L)
+
+    def save(self, file):
+        """
+        Write the stack to a binary file: a header holding the shape, pop_ids
+        and labels, then L, the mask and the spectra, each aligned to 8 bytes.
+        """
+        with open(file, "wb") as fout:
+            self._write(fout)
+        return
+
+    def _write(self, fout):
+        pop_ids = b"" if self.pop_ids is None \
+            else "\t".join(self.pop_ids).encode()
+        labels = "\t".join(self.labels).encode()
+        header = b"".join([
+            _STACK_MAGIC,
+            np.array(
+                [len(self.shape), len(pop_ids), len(labels)], dtype="<u4"
+            ).tobytes(),
+            np.array([len(self), *self.shape], dtype="<u8").tobytes(),
+            pop_ids,
+            labels,
+        ])
+        mask = self.mask.astype(np.uint8).tobytes()
+        fout.write(header + bytes(_pad_to(len(header))))
+        fout.write(self.L.astype("<f8").tobytes())
+        fout.write(mask + bytes(_pad_to(len(mask))))
+        # written one spectrum at a time, as `data` may be memory-mapped
+        for fs in self.data:
+            fout.write(np.asarray(fs, dtype="<f8").tobytes())
+        return
+
+    @classmethod
+    def load(cls, file, offset=0):
+        """
+        Memory-map a stack written by `save`, or one held in a larger file
+        from byte `offset` on.
+        """
+        start = offset
+        raw = np.memmap(file, dtype=np.uint8, mode="r", offset=start)
+        if bytes(raw[:4]) != _STACK_MAGIC:
+            raise ValueError(f"{file} is not a spectrum stack file")
+        ndim, ids_len, labels_len = raw[4:16].view("<u4").tolist()
+        offset = 16
+        num_spectra, *shape = raw[offset:offset + 8 * (ndim + 1)] \
+            .view("<u8").tolist()
+        offset += 8 * (ndim + 1)
+        pop_ids = bytes(raw[offset:offset + ids_len]).decode().split("\t") \
+            if ids_len > 0 else None
+        offset += ids_len
+        labels = bytes(raw[offset:offset + labels_len]).decode().split("\t") \
+            if num_spectra > 0 else []
+        offset += labels_len
+        offset += _pad_to(offset)
+        L = raw[offset:offset + 8 * num_spectra].view("<f8")
+        offset += 8 * num_spectra
+        size = int(np.prod(shape))
+        mask = raw[offset:offset + size].view(bool).reshape(shape)
+        offset += size + _pad_to(size)
+        data = np.memmap(
+            file, dtype="<f8", mode="r", offset=start + offset,
+            shape=(num_spectra, *shape)
+        )
+
+        return cls(data, mask, pop_ids, labels, L)
+
+
+def bootstrap_counts(num_windows, num_reps, seed=None):
+    """
+    Draw the number of times each of `num_windows` windows is resampled in
+    each of `num_reps` bootstrap replicates, as a (num_reps x num_windows)
+    matrix whose rows are multinomial draws of `num_windows` windows.
+    """
+    rng = np.random.default_rng(seed)
+    probs = np.full(num_windows, 1 / num_windows)
+
+    return rng.multinomial(num_windows, probs, size=num_reps)
+
+
+# identifies binary bootstrap replicate files
+_BOOTSTRAP_MAGIC = b"BTS1"
+
+
+class BootstrapReplicates:
+    """
+    Bootstrap replicates stored as the `SpectrumStack` of the resampled windows
+    and the (num_reps x num_windows) matrix of `counts` of each window in each
+    replicate. Replicates are summed from the windows on access, one at a time
+    or in batches, so they are never all held in memory. They can be passed as
+    `bootstraps` to moments.Demes.Inference.uncerts, with `uL` as
+    `bootstraps_uL`, or as `all_boot` to moments.Godambe.LRT_adjust.
+    """
+
+    def __init__(self, windows, counts):
+        counts = np.asarray(counts, dtype=np.int64)
+        if counts.ndim != 2 or counts.shape[1] != len(windows):
+            raise ValueError("expected one column of counts for each window")
+        self.windows = windows
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def L(self):
+        return self.counts @ self.windows.L
+
+    def uL(self, u):
+        """
+        Get the sequence length-scaled mutation rate of each replicate.
+        """
+        return u * self.L
+
+    def batch(self, reps=None):
+        """
+        Sum the replicates with indices `reps`, or all of them, into a
+        `SpectrumStack`.
+        """
+        reps = np.arange(len(self)) if reps is None else np.asarray(reps)
+
+        return self.windows.resample(
+            self.counts[reps], labels=[f"rep_{i}" for i in reps]
+        )
+
+    def __getitem__(self, i):
+        """
+        Get replicate `i` as a moments.Spectrum.
+        """
+        return self.batch([i])[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def save(self, file):
+        """
+        Write the replicates to a binary file: the shape of the counts, the
+        counts, then the window stack as written by `SpectrumStack.save`.
+        """
+        with open(file, "wb") as fout:
+            fout.write(_BOOTSTRAP_MAGIC + bytes(_pad_to(len(_BOOTSTRAP_MAGIC))))
+            fout.write(np.array(self.counts.shape, dtype="<u8").tobytes())
+            fout.write(self.counts.astype("<i8").tobytes())
+            self.windows._write(fout)
+        return
+
+    @classmethod
+    def load(cls, file):
+        """
+        Memory-map replicates written by `save`.
+        """
+        data = np.memmap(file, dtype=np.uint8, mode="r")
+        if bytes(data[:4]) != _BOOTSTRAP_MAGIC:
+            raise ValueError(f"{file} is not a bootstrap replicate file")
+        num_reps, num_windows = data[8:24].view("<u8").tolist()
+        offset = 24 + 8 * num_reps * num_windows
+        counts = data[24:offset].view("<i8").reshape(num_reps, num_windows)
+
+        return cls(SpectrumStack.load(file, offset=offset), counts)
+
+
+def jackknife_replicates(windows, pseudo=True):
+    """
+    Build the delete-one-window jackknife replicates of a `SpectrumStack`, as
+    the total spectrum and L minus those of each window, in one subtraction.
+
+    moments.Godambe and moments.Demes.Inference average the outer products of
+    the scores of bootstrap replicates, whose spread is that of the whole
+    data. By default the replicates are therefore returned as pseudo-replicates
+    whose deviations from the total are those of the leave-one-out replicates
+    scaled by sqrt(n - 1), so that this average is the jackknife variance of
+    the score and they can be passed wherever bootstrap replicates are, with
+    `u * L` as their uL.
+
+    Scaling L in the same way is only an approximation: the log-likelihood is
+    linear in the data but not in uL, so the scores of pseudo-replicates match
+    the scaled leave-one-out scores only to first order in the deviations of L.
+    Pseudo-replicates can also be negative in sparse entries, where
+    moments.Inference.ll is undefined, so such entries are set to zero with a
+    warning, which slightly biases them upward.
+    """
+    n = len(windows)
+    total = windows.data.sum(axis=0)
+    L_total = windows.L.sum()
+    data = total[None] - windows.data
+    L = L_total - windows.L
+    if pseudo:
+        scale = np.sqrt(n - 1)
+        data = total + scale * (data - data.mean(axis=0))
+        L = L_total + scale * (L - L.mean())
+        negative = (data < 0) & ~windows.mask
+        if np.any(negative):
+            warnings.warn(
+                f"set {np.count_nonzero(negative)} negative entries of "
+                "jackknife pseudo-replicates to zero"
+            )
+        data = np.maximum(data, 0)
+    labels = [f"without_{label}" for label in windows.labels]
+
+    return SpectrumStack(data, windows.mask, windows.pop_ids, labels=labels, L=L)
+
+
+class SpectrumIndex:
+    """
+    Prefix sums of the spectrum and of the callable length L of one chromosome
+    at sorted 1-indexed `checkpoints`: entry k holds the sum over sites before
+    checkpoint k. The spectrum and L of any interval between two checkpoints
+    are then the difference of two entries, so windows of any size that is a
+    multiple of the checkpoint spacing are formed without re-reading sites.
+    Indices are stored as a `SpectrumStack` of the prefix sums, labeled by
+    chrom and checkpoint.
+    """
+
+    def __init__(self, chromnum, checkpoints, stack):
+        self.chromnum = chromnum
+        self.checkpoints = np.asarray(checkpoints, dtype=np.int64)
+        self.stack = stack
+
+    @classmethod
+    def from_counts(cls, counts, checkpoints, regions=None, pops=None,
+                    sample_sizes=None, pass_only=False, complete_only=False):
+        """
+        Build an index from a `SiteCounts` cache. `regions` holds the callable
+        regions of the chromosome, which should be those the cache was built
+        with; L is NaN when they are not given. Other arguments are as in
+        `SiteCounts.spectra`.
+        """
+        checkpoints = np.asarray(checkpoints, dtype=np.int64)
+        spectra, _ = counts.spectra(
+            pops, windows=checkpoints, sample_sizes=sample_sizes,
+            pass_only=pass_only, complete_only=complete_only
+        )
+        data = np.zeros((len(checkpoints), *spectra.shape[1:]))
+        np.cumsum(spectra, axis=0, out=data[1:])
+        if regions is None:
+            L = np.full(len(checkpoints), np.nan)
+        else:
+            L = CallableLength(regions).covered_before(checkpoints - 1)
+        mask = np.zeros(data.shape[1:], dtype=bool)
+        mask.flat[[0, -1]] = True
+        labels = [f"{counts.chromnum}:{pos}" for pos in checkpoints]
+        stack = SpectrumStack(
+            data, mask, pops or counts.pop_ids, labels=labels, L=L
+        )
+
+        return cls(counts.chromnum, checkpoints, stack)
+
+    def save(self, file):
+        self.stack.save(file)
+        return
+
+    @classmethod
+    def load(cls, file):
+        """
+        Memory-map an index written by `save`.
+        """
+        stack = SpectrumStack.load(file)
+        chromnum = stack.labels[0].rsplit(":", 1)[0] if len(stack) > 0 else ""
+        checkpoints = [int(label.rsplit(":", 1)[1]) for label in stack.labels]
+
+        return cls(chromnum, checkpoints, stack)
+
+    def _lookup(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        k = np.searchsorted(self.checkpoints, positions)
+        at = k < len(self.checkpoints)
+        at[at] = self.checkpoints[k[at]] == positions[at]
+        if not np.all(at):
+            raise ValueError("interval bounds must fall on checkpoints")
+
+        return k
+
+    def windows(self, edges):
+        """
+        Get the spectra and L of the half-open windows between consecutive
+        1-indexed `edges`, which must fall on checkpoints. Returns a
+        `SpectrumStack` labeled by window.
+        """
+        k = self._lookup(edges)
+        data = self.stack.data[k[1:]] - self.stack.data[k[:-1]]
+        L = self.stack.L[k[1:]] - self.stack.L[k[:-1]]
+        labels = [
+            f"{self.chromnum}:{start}-{end}"
+            for start, end in zip(edges[:-1], edges[1:])
+        ]
+
+        return SpectrumStack(
+            data, self.stack.mask, self.stack.pop_ids, labels=labels, L=L
+        )
+
+    def interval(self, start, end):
+        """
+        Get the spectrum of the interval [start, end), as a moments.Spectrum,
+        and its L.
+        """
+        window = self.windows(np.array([start, end]))
+
+        return window[0], float(window.L[0])
+
+
+# number of rows formatted at once when writing text files
+_FORMAT_ROWS = 1 << 20
+
+
+def _format_rows(columns):
+    """
+    Format rows of tab-separated columns as bytes, without a Python loop over
+    rows. Each column is a bytes constant, an array of non-negative integers or
+    an array of strings. Fields are laid out in a byte matrix and the padding
+    is dropped with a boolean mask.
+    """
+    num_rows = max(len(col) for col in columns if not isinstance(col, bytes))
+    mats = []
+    masks = []
+    for j, col in enumerate(columns):
+        if isinstance(col, bytes):
+            mat = np.broadcast_to(np.frombuffer(col, dtype=np.uint8),
+                                  (num_rows, len(col)))
+            mask = np.ones(mat.shape, dtype=bool)
+        elif np.issubdtype(np.asarray(col).dtype, np.integer):
+            col = np.asarray(col, dtype=np.int64)
+            width = len(str(col.max())) if num_rows > 0 else 1
+            powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+            mat = (col[:, None] // powers % 10 + 48).astype(np.uint8)
+            num_digits = np.searchsorted(powers[::-1], col, side="right")
+            mask = np.arange(width) >= width - np.maximum(num_digits, 1)[:, None]
+        else:
+            col = np.asarray(col).astype("S")
+            mat = col.view(np.uint8).reshape(num_rows, col.itemsize)
+            mask = mat != 0
+        sep = b"\n" if j == len(columns) - 1 else b"\t"
+        mats += [mat, np.full((num_rows, 1), ord(sep), dtype=np.uint8)]
+        masks += [mask, np.ones((num_rows, 1), dtype=bool)]
+    lines = np.concatenate(mats, axis=1)[np.concatenate(masks, axis=1)]
+
+    return lines.tobytes()
+
+
+def _write_rows(file, chromnum, columns, begs, ends, header=b"", index=False,
+                **kwargs):
+    """
+    Format and write rows in chunks. Files ending in .gz are written in BGZF
+    format, with a tabix index if `index` is True; see `write_bgzf_table`.
+    `index` is ignored for uncompressed files.
+    """
+    num_rows = len(begs)
+    chunks = (
+        _format_rows([col if isinstance(col, bytes) else col[i:i + _FORMAT_ROWS]
+                      for col in columns])
+        for i in range(0, num_rows, _FORMAT_ROWS)
+    )
+    if file.endswith(".gz"):
+        write_bgzf_table(file, chromnum, chunks, begs, ends, header=header,
+                         index=index, **kwargs)
+    else:
+        with open(file, "wb") as fout:
+            fout.write(header)
+            for chunk in chunks:
+                fout.write(chunk)
     return
 
 
+def write_bedfile(file, regions, chromnum, index=False):
+    """
+    write a .bed file (supports .gz) from an array of mask regions. .gz files
+    are BGZF-compressed and, if `index` is True, indexed with tabix.
+    """
+    regions = np.asarray(regions, dtype=np.int64).reshape(-1, 2)
+    _write_rows(
+        file,
+        chromnum,
+        [chromnum.encode(), regions[:, 0], regions[:, 1]],
+        regions[:, 0],
+        regions[:, 1],
+        index=index,
+        col_beg=2,
+        col_end=3,
+        zero_based=True,
+    )
+    return
+
+
+def _sweep_regions(region_arrs, weights):
+    """
+    Sweep over the sorted endpoints of several region arrays. Each region adds
+    the weight of its array to the depth between its start and end. Returns an
+    array of breakpoints and the depth on each interval [breaks[i], breaks[i+1]).
+    The cost scales with the number of regions, not with their total length.
+    """
+    starts = np.concatenate([regions[:, 0] for regions in region_arrs])
+    ends = np.concatenate([regions[:, 1] for regions in region_arrs])
+    deltas = np.concatenate(
+        [np.full(len(regions), w, dtype=np.int64)
+         for regions, w in zip(region_arrs, weights)]
+    )
+    breaks, inverse = np.unique(
+        np.concatenate((starts, ends)), return_inverse=True
+    )
+    net = np.zeros(len(breaks), dtype=np.int64)
+    np.add.at(net, inverse, np.concatenate((deltas, -deltas)))
+    depth = np.cumsum(net)[:-1]
+
+    return breaks, depth
+
+
+def _depth_to_regions(breaks, keep):
+    """
+    Transform the boolean array `keep`, defined on the intervals between
+    consecutive breakpoints, into an array of regions. Adjacent kept intervals
+    are merged.
+    """
+    edges = np.diff(np.concatenate(([0], keep, [0])).astype(np.int8))
+    starts = breaks[np.where(edges == 1)[0]]
+    ends = breaks[np.where(edges == -1)[0]]
+    regions = np.stack([starts, ends], axis=1).astype(np.int64)
+
+    return regions
+
+
+def merge_regions(regions):
+    """
+    Merge overlapping and adjacent regions in a region array, returning a sorted
+    array of disjoint regions.
+    """
+    breaks, depth = _sweep_regions([regions], [1])
+    merged = _depth_to_regions(breaks, depth > 0)
+
+    return merged
+
+
 def intersect_regions(region_arrs):
     """
     Get a region array representing the intersection of sites in several input
-    region arrays.
+    region arrays. There is no limit on the number of input arrays.
     """
-    l = np.max([regs[-1, 1] for regs in region_arrs])
-    counter = np.zeros(l, dtype=np.uint8)
-    for regions in region_arrs:
-        boolmask = regions_to_boolmask(regions, l=l)
-        counter[~boolmask] += 1
-    isec_mask = counter < len(region_arrs)  # recall that 1 is `masked`
-    isec_regions = boolmask_to_regions(isec_mask)
+    merged = [merge_regions(regions) for regions in region_arrs]
+    breaks, depth = _sweep_regions(merged, [1] * len(merged))
+    isec_regions = _depth_to_regions(breaks, depth == len(merged))
 
     return isec_regions
 
@@ -83,13 +1975,8 @@ def union_regions(region_arrs):
     """
     Obtain a region array representing the union of sites in input region arrays
     """
-    l = np.max([regs[-1, 1] for regs in region_arrs])
-    counter = np.zeros(l, dtype=np.uint8)
-    for regions in region_arrs:
-        boolmask = regions_to_boolmask(regions, l=l)
-        counter[~boolmask] += 1
-    union_mask = counter == 0  # recall that 1 is `masked`
-    union_regions = boolmask_to_regions(union_mask)
+    breaks, depth = _sweep_regions(region_arrs, [1] * len(region_arrs))
+    union_regions = _depth_to_regions(breaks, depth > 0)
 
     return union_regions
 
@@ -102,7 +1989,7 @@ def flank_regions(region_arr, flank):
     starts[starts < 0] = 0
     ends = region_arr[:, 1] + flank
     flanked = np.stack((starts, ends), axis=1)
-    resolved = boolmask_to_regions(regions_to_boolmask(flanked))
+    resolved = merge_regions(flanked)
 
     return resolved
 
@@ -112,42 +1999,306 @@ def subtract_regions(regions, subtrahend):
     Get an array of regions representing sites which belong to `regions` and
     not to `subtrahend`.
     """
-    l = max(regions[-1, 1], subtrahend[-1, 1])
-    boolmask = regions_to_boolmask(regions, l=l)
-    submask = regions_to_boolmask(subtrahend, l=l)
-    indicator = ~submask 
-    counter = boolmask + indicator
-    outmask = counter == 1
-    ret = boolmask_to_regions(outmask)
+    # sites in `regions` alone have depth 1, sites in both have depth 0
+    breaks, depth = _sweep_regions(
+        [merge_regions(regions), merge_regions(subtrahend)], [1, -1]
+    )
+    ret = _depth_to_regions(breaks, depth == 1)
 
     return ret
 
 
-def load_fa_array(file):
+def regions_overlap(regions):
     """
-    Load the characters in a .fa file and return them as a numpy array.
+    Check whether any two regions in a region array share a site.
     """
-    lines = []
-    line0 = None
+    if len(regions) < 2:
+        return False
+    regions = regions[np.argsort(regions[:, 0], kind="stable")]
+    reach = np.maximum.accumulate(regions[:-1, 1])
+
+    return bool(np.any(regions[1:, 0] < reach))
+
+
+class CallableLength:
+    """
+    An index of the number of sites covered by a set of regions, such as the
+    regions of a mask: the sorted ends of the merged regions and the total
+    length of the regions up to each end. The length L of any interval, or of
+    an array of intervals, is found by binary search in O(log n) time.
+    """
+
+    def __init__(self, regions):
+        merged = merge_regions(regions)
+        self.starts = merged[:, 0]
+        self.ends = merged[:, 1]
+        self.cum_lengths = np.concatenate(
+            ([0], np.cumsum(self.ends - self.starts))
+        )
+
+    @classmethod
+    def from_bedfile(cls, file):
+        regions, _ = read_bedfile(file)
+
+        return cls(regions)
+
+    @property
+    def total(self):
+        return int(self.cum_lengths[-1])
+
+    def covered_before(self, positions):
+        """
+        Count the covered sites before each 0-indexed position.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        # regions ending before a position are covered in full
+        k = np.searchsorted(self.ends, positions, side="right")
+        partial = np.zeros(len(positions), dtype=np.int64)
+        inside = k < len(self.ends)
+        partial[inside] = np.maximum(
+            positions[inside] - self.starts[k[inside]], 0
+        )
+
+        return self.cum_lengths[k] + partial
+
+    def lengths(self, starts, ends):
+        """
+        Get the L of each half-open interval [starts, ends), with 1-indexed
+        bounds as in moments.Parsing.compute_L.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        if np.any(starts < 1):
+            raise ValueError("intervals must start at positions > 0")
+
+        return self.covered_before(np.asarray(ends) - 1) \
+            - self.covered_before(starts - 1)
+
+    def interval(self, start, end):
+        """
+        Get the L of the interval [start, end), as moments.Parsing.compute_L
+        does with its `interval` argument.
+        """
+        return int(self.lengths([start], [end])[0])
+
+    def windows(self, edges):
+        """
+        Get the L of the half-open windows between consecutive 1-indexed
+        `edges`.
+        """
+        edges = np.asarray(edges, dtype=np.int64)
+
+        return self.lengths(edges[:-1], edges[1:])
+
+
+def _build_fai(data):
+    """
+    Build a .fai index for the .fa file held in the uint8 array `data`. Returns
+    a dict mapping sequence names to (length, offset, line bases, line width)
+    tuples, as in the columns of a samtools .fai file.
+    """
+    newlines = np.flatnonzero(data == 10)
+    headers = np.flatnonzero(data == ord(">"))
+    index = {}
+    for i, header in enumerate(headers):
+        header_end = newlines[np.searchsorted(newlines, header)]
+        name = bytes(data[header + 1:header_end]).split()[0].decode()
+        offset = header_end + 1
+        seq_end = headers[i + 1] if i + 1 < len(headers) else len(data)
+        lo, hi = np.searchsorted(newlines, [offset, seq_end])
+        widths = np.diff(np.concatenate(([offset], newlines[lo:hi] + 1)))
+        if len(widths) > 0 and np.any(widths[:-1] != widths[0]):
+            raise ValueError(f"sequence {name} has lines of differing lengths")
+        line_width = int(widths[0]) if len(widths) > 0 else 1
+        line_bases = line_width - 1
+        if line_bases > 0 and data[offset + line_bases - 1] == 13:
+            line_bases -= 1
+        num_lines = hi - lo
+        length = (seq_end - offset) - num_lines * (line_width - line_bases)
+        index[name] = (int(length), int(offset), line_bases, line_width)
+
+    return index
+
+
+def _read_fai(file):
+    index = {}
     with open(file, "r") as fin:
         for line in fin:
-            if ">" in line:
-                line0 = line
-                continue
-            lines.append(line.rstrip("\n"))
-    array = np.array([c for c in "".join(lines)])
+            name, length, offset, line_bases, line_width = line.split()[:5]
+            index[name] = tuple(
+                int(x) for x in (length, offset, line_bases, line_width)
+            )
+    return index
+
+
+class FastaFile:
+    """
+    A memory-mapped .fa file. Sequences are located with a .fai index, which is
+    read if present and newer than the file, and otherwise built and written
+    next to it. Bases are returned as uint8 ASCII codes without loading the
+    file into memory.
+    """
 
-    return line0, array
+    def __init__(self, file):
+        self.data = np.memmap(file, dtype=np.uint8, mode="r")
+        fai_file = file + ".fai"
+        if not is_stale(fai_file, file):
+            self.index = _read_fai(fai_file)
+        else:
+            self.index = _build_fai(self.data)
+            with open(fai_file, "w") as fout:
+                for name, fields in self.index.items():
+                    fout.write("\t".join(map(str, (name,) + fields)) + "\n")
 
+    @property
+    def names(self):
+        return list(self.index)
 
-def write_tab_file(file, positions, states, chromnum):
+    def length(self, name):
+        return self.index[name][0]
+
+    def _byte_offsets(self, name, positions):
+        length, offset, line_bases, line_width = self.index[name]
+        positions = np.asarray(positions, dtype=np.int64)
+        if np.any((positions < 0) | (positions >= length)):
+            raise IndexError(f"positions out of range for sequence {name}")
+        return offset + positions // line_bases * line_width \
+            + positions % line_bases
+
+    def fetch(self, name, start=0, end=None):
+        """
+        Get the bases in the 0-indexed range [start, end) of sequence `name`.
+        Ranges within a single line are returned as views into the memory map;
+        longer ranges are copied with line breaks removed.
+        """
+        length = self.length(name)
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return np.zeros(0, dtype=np.uint8)
+        first, last = self._byte_offsets(name, [start, end - 1])
+        seq = self.data[first:last + 1]
+        if last - first + 1 > end - start:
+            seq = seq[(seq != 10) & (seq != 13)]
+
+        return seq
+
+    def take(self, name, positions):
+        """
+        Get the bases at an array of 0-indexed positions of sequence `name`.
+        """
+        return self.data[self._byte_offsets(name, positions)]
+
+
+# 2-bit codes of nucleotides in ancestral state caches, indexed by ASCII code
+_NT_CODES = np.zeros(256, dtype=np.uint8)
+_NT_CODES[np.frombuffer(b"ACGTacgt", dtype=np.uint8)] = [0, 1, 2, 3] * 2
+_CODE_NTS = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+_CACHE_MAGIC = b"ANC1"
+
+
+class AncestralStates:
     """
-    Write ancestral states to a .tab file with columns CHROM, POS, STATE.
+    The ancestral states of one chromosome in compact binary form: a 2-bit code
+    per site for A, C, G or T, and a `PackedMask` of sites with high-confidence
+    (upper case) states. Sites with other characters in the .fa file, such as
+    `N` or `.`, are outside the mask and their codes are meaningless. Caches
+    are built once from an .fa file and memory-mapped when loaded.
     """
-    openfunc = gzip.open if file.endswith(".gz") else open 
-    with openfunc(file, "wb") as fout:
-        fout.write("#CHROM\tPOS\tSTATE\n".encode())
-        for pos, state in zip(positions, states):
-            lineb = f"{chromnum}\t{pos}\t{state}\n".encode()
-            fout.write(lineb)
-    return
\ No newline at end of file
+
+    def __init__(self, name, codes, mask):
+        self.name = name
+        self.codes = codes
+        self.mask = mask
+
+    @property
+    def length(self):
+        return self.mask.length
+
+    @classmethod
+    def from_fasta(cls, fa, name):
+        """
+        Convert sequence `name` of a `FastaFile`, one chunk at a time.
+        """
+        length = fa.length(name)
+        codes = np.zeros((length + 3) // 4, dtype=np.uint8)
+        bits = np.zeros((length + 7) // 8, dtype=np.uint8)
+        for c0 in range(0, length, _CHUNK_SIZE):
+            seq = fa.fetch(name, c0, c0 + _CHUNK_SIZE)
+            quads = np.zeros((len(seq) + 3) // 4 * 4, dtype=np.uint8)
+            quads[:len(seq)] = _NT_CODES[seq]
+            quads = quads.reshape(-1, 4)
+            codes[c0 // 4:c0 // 4 + len(quads)] = (quads[:, 0] << 6) \
+                | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+            packed = np.packbits(is_high_confidence(seq))
+            bits[c0 // 8:c0 // 8 + len(packed)] = packed
+
+        return cls(name, codes, PackedMask(bits, length))
+
+    def save(self, file):
+        """
+        Write the cache to a binary file: a header holding the sequence name
+        and length, then the packed codes and the packed mask.
+        """
+        name = self.name.encode()
+        with open(file, "wb") as fout:
+            fout.write(_CACHE_MAGIC)
+            fout.write(np.array([len(name)], dtype="<u4").tobytes())
+            fout.write(name)
+            fout.write(np.array([self.length], dtype="<u8").tobytes())
+            fout.write(np.asarray(self.codes).tobytes())
+            fout.write(np.asarray(self.mask.bits).tobytes())
+        return
+
+    @classmethod
+    def load(cls, file):
+        """
+        Memory-map a cache written by `save`.
+        """
+        data = np.memmap(file, dtype=np.uint8, mode="r")
+        if bytes(data[:4]) != _CACHE_MAGIC:
+            raise ValueError(f"{file} is not an ancestral state cache")
+        name_len = int(data[4:8].view("<u4")[0])
+        name = bytes(data[8:8 + name_len]).decode()
+        offset = 8 + name_len
+        length = int(data[offset:offset + 8].view("<u8")[0])
+        offset += 8
+        codes = data[offset:offset + (length + 3) // 4]
+        offset += len(codes)
+        bits = data[offset:offset + (length + 7) // 8]
+
+        return cls(name, codes, PackedMask(bits, length))
+
+    def take(self, positions):
+        """
+        Get the states at an array of 0-indexed positions as upper case ASCII
+        codes, along with a boolean array flagging high-confidence states.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        if np.any((positions < 0) | (positions >= self.length)):
+            raise IndexError(f"positions out of range for sequence {self.name}")
+        shifts = (6 - 2 * (positions & 3)).astype(np.uint8)
+        states = _CODE_NTS[(self.codes[positions >> 2] >> shifts) & 3]
+        high_conf = (self.mask.bits[positions >> 3]
+                     >> (7 - (positions & 7)).astype(np.uint8)) & 1
+
+        return states, high_conf.astype(bool)
+
+
+def write_tab_file(file, positions, states, chromnum, index=False):
+    """
+    Write ancestral states to a .tab file with columns CHROM, POS, STATE. .gz
+    files are BGZF-compressed and, if `index` is True, indexed with tabix.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    _write_rows(
+        file,
+        chromnum,
+        [chromnum.encode(), positions, np.asarray(states)],
+        positions - 1,
+        positions,
+        header=b"#CHROM\tPOS\tSTATE\n",
+        index=index,
+        col_beg=2,
+        col_end=2,
+    )
+    return
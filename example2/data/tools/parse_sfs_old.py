@@ -1,93 +1,107 @@
 ## Parse the SFS from a .vcf file with ancestral state annotations, then save it
-## Uses a function adapted from the `from_data_dict` method of the Spectrum
-## class in moments.Spectrum_mod.
+## Genotypes are decoded in chunks into a matrix of alleles and tallied with
+## `parse_vcf_sfs` from lib.py, rather than through the per-SNP data dictionary
+## of moments.Misc.make_data_dict_vcf. Sites must pass all filters, as before.
+## Pass -P to parse only some populations, so that the samples of others are
+## never decoded, and -n to project populations down as the .vcf is read.
+## Populations keep the order in which they appear in the population file.
+## With -s the spectrum is held and written sparsely, as a `SparseSpectrum`.
+## With -c the spectrum is computed from a site count cache written by
+## build_count_cache.py instead of a .vcf file.
 
 import argparse
-from collections import defaultdict
 import moments 
 import numpy as np
 
+from lib import *
+
 
 def get_args():
 
     parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "-v", "--vcf_file", type=str, required=True
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "-v", "--vcf_file", type=str
+    )
+    source.add_argument(
+        "-c", "--cache_file", type=str,
+        help="site count cache to read in place of a .vcf file"
     )
     parser.add_argument(
-        "-p", "--population_file", type=str, required=True
+        "-p", "--population_file", type=str, default=None,
+        help="required with -v"
     )
     parser.add_argument(
         "-o", "--out_file", type=str, required=True
     )
+    parser.add_argument(
+        "-P", "--pops", type=str, nargs="*", default=None,
+        help="populations to parse; only their samples are decoded"
+    )
+    parser.add_argument(
+        "-n", "--sample_sizes", type=int, nargs="*", default=None,
+        help="haploid sample sizes to project each population to while parsing"
+    )
+    parser.add_argument(
+        "-s", "--sparse", action="store_true",
+        help="write a binary sparse spectrum instead of a dense .fs file"
+    )
 
     return parser.parse_args()
 
 
-def compute_sfs(data_dict, pop_ids, sample_sizes, mask_corners=True):
-    """
-    Compute the SFS from a data dictionary. Details on this format can be found
-    in the moments.Misc module.
-    """
-    Npops = len(pop_ids)
-    fs = np.zeros(np.asarray(sample_sizes) + 1)
-    for snp, snp_info in data_dict.items():
-        # Skip SNPs that aren't biallelic.
-        if len(snp_info["segregating"]) != 2:
-            continue
-
-        allele1, allele2 = snp_info["segregating"]
-        if (
-            "outgroup_allele" in snp_info
-            and snp_info["outgroup_allele"] != "-"
-            and snp_info["outgroup_allele"] in snp_info["segregating"]
-        ):
-            # Otherwise we need to check that it's a useful outgroup
-            outgroup_allele = snp_info["outgroup_allele"]
-        else:
-            # If we're polarized and we didn't have good outgroup info, skip
-            # this SNP.
-            continue
-
-        # Extract the allele calls for each population.
-        allele1_calls = [snp_info["calls"][pop][0] for pop in pop_ids]
-        allele2_calls = [snp_info["calls"][pop][1] for pop in pop_ids]
-        # assume all chromosomes were called
-        # How many chromosomes did we call successfully in each population?
-        successful_calls = [
-            a1 + a2 for (a1, a2) in zip(allele1_calls, allele2_calls)
-        ]
-        assert np.all(successful_calls == sample_sizes)
-
-        # Which allele is derived (different from outgroup)?
-        if allele1 == outgroup_allele:
-            derived_calls = allele2_calls
-        elif allele2 == outgroup_allele:
-            derived_calls = allele1_calls
-        fs[tuple(derived_calls)] += 1
-
-    fsout = moments.Spectrum(fs, mask_corners=mask_corners, pop_ids=pop_ids)
-    assert np.all(fsout >= 0)
-
-    return fsout
-
-
 def main():
 
     args = get_args()
-    vcf_file = args.vcf_file
-    pop_file = args.population_file
     out_file = args.out_file
-    pop_dict = defaultdict(int)
-    with open(pop_file, "r") as fin:
-        for line in fin:
-            pop = line.split()[1]
-            pop_dict[pop] += 2
-    pops = list(pop_dict.keys())
-    nums = [pop_dict[pop] for pop in pops]
-    data_dict = moments.Misc.make_data_dict_vcf(vcf_file, pop_file)
-    sfs = compute_sfs(data_dict, pops, nums)
-    sfs.to_file(out_file)
+    if args.cache_file is not None:
+        counts = SiteCounts.load(args.cache_file)
+        pops = counts.pop_ids
+        if args.pops is not None:
+            for pop in args.pops:
+                if pop not in pops:
+                    raise ValueError(
+                        f"population {pop} is absent from {args.cache_file}"
+                    )
+            pops = [pop for pop in pops if pop in args.pops]
+        spectra, _ = counts.spectra(
+            pops,
+            sample_sizes=args.sample_sizes,
+            pass_only=True,
+            sparse=args.sparse,
+        )
+    else:
+        vcf_file = args.vcf_file
+        pop_file = args.population_file
+        if pop_file is None:
+            raise ValueError("a population file is required with a .vcf file")
+        pop_mapping = read_pop_file(pop_file)
+        if args.pops is not None:
+            for pop in args.pops:
+                if pop not in pop_mapping:
+                    raise ValueError(
+                        f"population {pop} is absent from {pop_file}"
+                    )
+            pop_mapping = {
+                pop: samples for pop, samples in pop_mapping.items()
+                if pop in args.pops
+            }
+        pops = list(pop_mapping.keys())
+        spectra, _ = parse_vcf_sfs(
+            vcf_file,
+            pop_mapping,
+            sample_sizes=args.sample_sizes,
+            pass_only=True,
+            sparse=args.sparse,
+        )
+    if args.sparse:
+        sfs = spectra[0]
+        assert np.all(sfs.values >= 0)
+        sfs.save(out_file)
+    else:
+        sfs = moments.Spectrum(spectra[0], mask_corners=True, pop_ids=pops)
+        assert np.all(sfs >= 0)
+        sfs.to_file(out_file)
 
     return
 
@@ -1,10 +1,12 @@
 ## add together spectra from several saved .sfs files and write the sum. Also
-## marginalizes to the populations MSL, CHS, GBR, Vindija
+## marginalizes to the populations MSL, CHS, GBR, Vindija, although spectra
+## parsed with `parse_sfs_old.py -P` hold only these populations already.
+## Input spectra may be .fs files or binary sparse spectra, and are added and
+## marginalized sparsely; only the sum is made dense, to be written.
 
 import argparse
-from collections import defaultdict
-import moments 
-import numpy as np
+
+from lib import *
 
 
 def get_args():
@@ -26,16 +28,16 @@ def main():
     sfs_files = args.sfs_files
     out_file = args.out_file
     to_pops = ["MSL", "CHS", "GBR", "Vindija"]
-    sum_arr = 0
+    sum_sfs = 0
     for file in sfs_files:
-        sfs = moments.Spectrum.from_file(file)
+        sfs = load_spectrum(file)
         pop_ids = sfs.pop_ids
         to_marg = [pop_ids.index(pop) for pop in pop_ids if pop not in to_pops]
-        _sfs = sfs.marginalize(to_marg)
-        sum_arr += np.asarray(_sfs)
-    pop_ids = _sfs.pop_ids
-    sum_sfs = moments.Spectrum(sum_arr, mask_corners=True, pop_ids=pop_ids)
-    sum_sfs.to_file(out_file)
+        _sfs = sfs.marginalize(to_marg) if len(to_marg) > 0 else sfs
+        sum_sfs = sum_sfs + _sfs
+    sum_fs = sum_sfs.to_spectrum()
+    sum_fs.mask_corners()
+    sum_fs.to_file(out_file)
 
     return
 
@@ -3,7 +3,10 @@
 import demes
 import moments
 import numpy as np
-import pickle
+import sys
+
+sys.path.append("data/tools")
+from lib import BootstrapReplicates
 
 
 # parameters
@@ -24,10 +27,8 @@ misid_1 = 0.0223
 data_file = "spectra/MSL_GBR_Vindija.fs"
 data = moments.Spectrum.from_file(data_file)
 
-bootstrap_data_file = "data/bootstrap_data.pkl"
-with open(bootstrap_data_file, "rb") as fin:
-    all_boot = pickle.load(fin)
-all_boot = [x[0] for x in all_boot]
+bootstrap_data_file = "data/bootstrap_data.boot"
+all_boot = BootstrapReplicates.load(bootstrap_data_file)
 
 
 graph_0 = demes.load(model_0_file)